@@ -1,22 +1,35 @@
 # pylint: disable=line-too-long
 
+import asyncio
+import base64
 import json
 import logging
+import math
 import os
-from urllib.parse import unquote
+from urllib.parse import unquote, urlencode
 
+import queries
+from cache import QueryCache
 from celery import Celery
-from flask import Flask, redirect, render_template, request, url_for
-from neo4j import GraphDatabase
-from utils import emotions_chart
+from database import Database
+from facets import FacetIndex
+from metrics import instrument, metrics_response, observe_stream
+from quart import (
+    Quart,
+    abort,
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    stream_template,
+    stream_with_context,
+    url_for,
+)
+from utils import chart_name
 
 # App
-app = Flask(__name__)
-
-# Parameters
-app.config["UPLOAD_FOLDER"] = os.path.join("static", "plots")
-if not os.path.exists(os.path.join("static", "plots")):
-    os.makedirs(os.path.join("static", "plots"))
+app = Quart(__name__)
+instrument(app)
 
 # Logging
 log = logging.getLogger(__name__)
@@ -25,8 +38,28 @@ log = logging.getLogger(__name__)
 with open("config.json") as f:
     config = json.load(f)
 
+# Parameters
+# Charts are written by the worker into the static volume nginx serves
+app.config["UPLOAD_FOLDER"] = config.get(
+    "charts_dir", os.path.join("static", "plots")
+)
+if not os.path.exists(app.config["UPLOAD_FOLDER"]):
+    os.makedirs(app.config["UPLOAD_FOLDER"])
+CHARTS_URL = config.get("charts_url", "/static/plots").rstrip("/")
+
 # Database
-neo = GraphDatabase.driver(config["neo4j"]["url"], encrypted=False)
+database = Database(**config["neo4j"])
+
+
+@app.before_serving
+async def connect():
+    await database.connect()
+
+
+@app.after_serving
+async def disconnect():
+    await database.close()
+
 
 # Asyncworker
 broker_url = result_backend = os.getenv("REDIS_URL", "redis://redis:6379")
@@ -37,44 +70,169 @@ celery_parameters = {
 }
 celery_app = Celery(**celery_parameters)
 
+# Query cache
+query_cache = QueryCache(broker_url)
+
+# Pagination
+PAGE_SIZE = config.get("page_size", 50)
+MAX_PAGE_SIZE = config.get("max_page_size", 500)
+STREAM_CHUNK_SIZE = 16 * 1024
+
+RATINGS = [
+    "critics_rating",
+    "audience_score",
+    "imdb_rating",
+    "critics_score",
+    "joy",
+    "disgust",
+    "fear",
+    "anger",
+    "sadness",
+]
+
 
 @app.errorhandler(404)
-def not_found_error(_error):
-    return render_template("404.html"), 404
+async def not_found_error(_error):
+    return await render_template("404.html"), 404
 
 
 @app.errorhandler(500)
-def internal_error(error):
-    return render_template("500.html", params=request.args, error=error), 500
+async def internal_error(error):
+    return (
+        await render_template("500.html", params=request.args, error=error),
+        500,
+    )
 
 
-@app.route("/")
-def home():
-    with neo.session() as session:
-        count = (
-            session.run("MATCH (m:Movie) RETURN count(m.slug)")
-            .single()
-            .value()
+async def cached_values(name, **parameters):
+    async def run():
+        return [value async for value in database.column(name, **parameters)]
+
+    return await query_cache.get(name, parameters, run)
+
+
+def streamed_values(name, **parameters):
+    # Rendered while it is read, from Redis or from Neo4j
+    return query_cache.stream(
+        name, parameters, lambda: database.column(name, **parameters)
+    )
+
+
+def render_stream(template, **context):
+    # Jinja yields every fragment of the template on its own; they are sent
+    # to the client in chunks of at least STREAM_CHUNK_SIZE characters.
+    @stream_with_context
+    async def chunks():
+        buffer, size = [], 0
+        async for fragment in await stream_template(template, **context):
+            buffer.append(fragment)
+            size += len(fragment)
+            if size >= STREAM_CHUNK_SIZE:
+                yield "".join(buffer)
+                buffer, size = [], 0
+        if buffer:
+            yield "".join(buffer)
+
+    return observe_stream(chunks())
+
+
+async def load_facets():
+    return await database.data("facets")
+
+
+# Rebuilt from Neo4j whenever the worker bumps the data generation
+facet_index = FacetIndex(load_facets, query_cache.generation)
+
+
+def page_parameters():
+    try:
+        limit = int(request.args.get("limit", PAGE_SIZE))
+        after = request.args.get("after")
+        if after:
+            after = json.loads(base64.urlsafe_b64decode(after.encode()))
+    except ValueError:
+        abort(400)
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        abort(400)
+    if after and not valid_cursor(after):
+        abort(400)
+    return after or None, limit
+
+
+def valid_cursor(after):
+    # The cursor comes back from the client, so its values are checked
+    # before they reach Neo4j or the facet index
+    if not isinstance(after, dict) or set(after) != {"rank", "id"}:
+        return False
+    rank = after["rank"]
+    return (
+        isinstance(rank, (int, float))
+        and not isinstance(rank, bool)
+        and math.isfinite(rank)
+        and isinstance(after["id"], str)
+    )
+
+
+async def media_page(statement, filter_, as_json, /, **parameters):
+    # One row more than the page tells whether there is a next page
+    after, limit = page_parameters()
+    records = [
+        record
+        async for record in database.records(
+            statement, after=after, limit=limit + 1, **parameters
         )
-    return render_template("home.html", count=count)
+    ]
+    return await render_page(records, limit, filter_, as_json)
+
+
+async def render_page(records, limit, filter_, as_json):
+    media = [record["media"] for record in records[:limit]]
+
+    cursor = None
+    if len(records) > limit:
+        last = records[limit - 1]
+        cursor = base64.urlsafe_b64encode(
+            json.dumps(
+                {"rank": last["rank"], "id": last["media"]["id"]}
+            ).encode()
+        ).decode()
+
+    if as_json:
+        return jsonify(media=media, next=cursor)
+    next_url = None
+    if cursor:
+        args = request.args.to_dict(flat=False)
+        args["after"] = cursor
+        next_url = f"{request.path}?{urlencode(args, doseq=True)}"
+    return await render_template(
+        "media_list.html", media=media, filter=filter_, next=next_url
+    )
+
+
+@app.route("/metrics")
+async def metrics():
+    return metrics_response()
+
+
+@app.route("/")
+async def home():
+    count = (await database.single("count")).value()
+    return await render_template("home.html", count=count)
 
 
 @app.route("/choose")
-def choose():
-    with neo.session() as session:
-        categories = session.run(
-            "MATCH (c:Category) RETURN DISTINCT c.name ORDER BY c.name",
-        ).values()
-        categories = [item for sublist in categories for item in sublist]
-        genres = session.run(
-            "MATCH (g:Genre) RETURN DISTINCT g.name ORDER BY g.name"
-        ).values()
-        genres = [item for sublist in genres for item in sublist]
-    return render_template("choose.html", categories=categories, genres=genres)
+async def choose():
+    categories, genres = await asyncio.gather(
+        cached_values("categories"), cached_values("genres")
+    )
+    return await render_template(
+        "choose.html", categories=categories, genres=genres
+    )
 
 
 @app.route("/choose/results")
-def choose_results():
+@app.route("/choose/results.json", defaults={"as_json": True})
+async def choose_results(as_json=False):
 
     media_type = request.args.get("type")
     genres = request.args.getlist("genres")
@@ -82,286 +240,205 @@ def choose_results():
     rating = request.args.get("rating")
     year = request.args.get("year")
 
-    params = []
-    if media_type:
-        params.append(f'type: "{media_type}"')
-    if year:
-        params.append(f"year: {year}")
-    join_params = ",".join(params)
-
-    if join_params:
-        queries = [f"MATCH (m: Movie {join_params})\n"]
-    else:
-        queries = ["MATCH (m: Movie)\n"]
-
-    if rating:
-        queries.append(f"WHERE m.imdb_rating > {rating}\n")
-    if genres:
-        for genre in genres:
-            if genre:
-                queries.append(
-                    'MATCH (m)<-[:HAS_MOVIE]-(:Genre {name: "%s"})\n'
-                    % unquote(genre)
-                )
-    if categories:
-        for category in categories:
-            if category:
-                queries.append(
-                    'MATCH (m)<-[:HAS_MOVIE]-(:Category {name: "%s"})\n'
-                    % unquote(category)
-                )
-    queries.append(
-        """RETURN {title: m.name, id: m.imdb_id, poster: m.poster, description: m.description, rating: m.imdb_rating}
-        ORDER BY m.imdb_rating DESC
-        """
+    try:
+        year = int(year) if year else None
+        rating = float(rating) if rating else None
+    except ValueError:
+        abort(400)
+
+    after, limit = page_parameters()
+    facets = await facet_index.get()
+    page = facets.page(
+        after,
+        limit + 1,
+        type=media_type or None,
+        year=year,
+        rating=rating,
+        genres=[unquote(genre) for genre in genres if genre],
+        categories=[unquote(category) for category in categories if category],
     )
-
-    query = " ".join(queries)
-
-    with neo.session() as session:
-        media = session.run(query).values()
-        media = [item for sublist in media for item in sublist]
-    return render_template("media_list.html", media=media, filter=request.args)
+    media = {
+        record["media"]["id"]: record["media"]
+        async for record in database.records(
+            "media_by_ids", ids=[id_ for id_, _ in page]
+        )
+    }
+    records = [
+        {"media": media[id_], "rank": rank}
+        for id_, rank in page
+        if id_ in media
+    ]
+    return await render_page(records, limit, request.args, as_json)
 
 
 @app.route("/update", methods=["POST"])
-def update_db():
-    celery_app.send_task("tasks.update_database", queue="default")
+async def update_db():
+    await asyncio.to_thread(
+        celery_app.send_task, "tasks.update_database", queue="default"
+    )
     return redirect(url_for("home"))
 
 
 @app.route("/similarity", methods=["POST"])
-def similarity():
-    celery_app.send_task("tasks.find_similarities", queue="default")
+async def similarity():
+    form = await request.form
+    await asyncio.to_thread(
+        celery_app.send_task,
+        "tasks.find_similarities",
+        kwargs={"incremental": bool(form.get("incremental"))},
+        queue="default",
+    )
     return redirect(url_for("home"))
 
 
 @app.route("/rating")
-def choose_best():
-    ratings = [
-        "critics_rating",
-        "audience_score",
-        "imdb_rating",
-        "critics_score",
-        "joy",
-        "disgust",
-        "fear",
-        "anger",
-        "sadness",
-    ]
-    return render_template("media_filter.html", filter="rating", items=ratings)
+async def choose_best():
+    return await render_template(
+        "media_filter.html", filter="rating", items=RATINGS
+    )
 
 
 @app.route("/rating/media")
-def best_media():
+@app.route("/rating/media.json", defaults={"as_json": True})
+async def best_media(as_json=False):
     rating = unquote(request.args.get("rating"))
-    with neo.session() as session:
-        media = session.run(
-            """MATCH (m:Movie)
-            WHERE m.%s IS NOT NULL
-            WITH m
-            ORDER BY m.%s DESC
-            RETURN {title: m.name, id: m.imdb_id, poster: m.poster, description: m.description, rating: m.%s}
-            """
-            % (rating, rating, rating)
-        ).values()
-        media = [item for sublist in media for item in sublist]
-    return render_template("media_list.html", filter=rating, media=media)
+    if rating not in RATINGS:
+        abort(404)
+    return await media_page("best_media", rating, as_json, rating=rating)
 
 
 @app.route("/media")
-def search_media():
-    return render_template("media_search.html")
+async def search_media():
+    return await render_template("media_search.html")
+
+
+@app.route("/media/search")
+@app.route("/media/search.json", defaults={"as_json": True})
+async def search_results(as_json=False):
+    text = request.args.get("q", "")
+    query = queries.search_query(text)
+    if query is None:
+        if as_json:
+            return jsonify(media=[], next=None)
+        return redirect(url_for("search_media"))
+    return await media_page("search_media", text, as_json, query=query)
 
 
 @app.route("/media/details")
-def get_media():
+async def get_media():
     media_id = unquote(request.args.get("id"))
-    with neo.session() as session:
-        media = (
-            session.run(
-                """MATCH (m:Movie {imdb_id: '%s'})
-                RETURN m as movie
-                """
-                % media_id
-            )
-            .single()
-            .value()
-        )
-        categories = session.run(
-            """MATCH (m:Movie {imdb_id: '%s'})<-[:HAS_MOVIE]-(c:Category)
-            RETURN DISTINCT c.name
-            """
-            % media_id
-        ).values()
-        genres = session.run(
-            """MATCH (m:Movie {imdb_id: '%s'})<-[:HAS_MOVIE]-(g:Genre)
-            RETURN DISTINCT g.name
-            """
-            % media_id
-        ).values()
-
-        categories = [item for sublist in categories for item in sublist]
-        genres = [item for sublist in genres for item in sublist]
-
-        similar = session.run(
-            """MATCH (m:Movie {imdb_id: '%s'})
-            OPTIONAL MATCH (m)-[:SIMILAR]-(om:Movie)
-            WITH om
-            ORDER BY om.imdb_rating DESC
-            RETURN collect({id: om.imdb_id, title: om.name, poster: om.poster, description: om.description, rating: om.imdb_rating}) as similar
-            """
-            % media_id
-        ).values()
-        similar = similar[0][0]
 
+    async def run():
+        record = await database.single("media_details", id=media_id)
+        if record is None:
+            return None
+        return {
+            "movie": dict(record["movie"]),
+            "categories": record["categories"],
+            "genres": record["genres"],
+            "similar": record["similar"],
+        }
+
+    details = await query_cache.get("media_details", {"id": media_id}, run)
+    if details is None:
+        abort(404)
+    media = details["movie"]
+    categories = details["categories"]
+    genres = details["genres"]
+    similar = details["similar"]
+
+    # Charts are rendered by the worker; a missing one is queued and shows
+    # up on a later visit
     try:
-        filename = emotions_chart(media, app.config["UPLOAD_FOLDER"])
+        filename = chart_name(media)
     except KeyError:
         filename = None
-    return render_template(
+    if filename is not None and not os.path.exists(
+        os.path.join(app.config["UPLOAD_FOLDER"], filename)
+    ):
+        await asyncio.to_thread(
+            celery_app.send_task,
+            "tasks.render_emotion_charts",
+            kwargs={"imdb_ids": [media["imdb_id"]]},
+            queue="default",
+        )
+        filename = None
+    return await render_template(
         "media_details.html",
         media=media,
         genres=genres,
         categories=categories,
         similar=similar,
-        plot=filename,
+        plot=f"{CHARTS_URL}/{filename}" if filename else None,
     )
 
 
 @app.route("/actors")
-def choose_actors():
-    with neo.session() as session:
-        actors = session.run(
-            """MATCH (p:Person)-[:ACTED_IN]->(:Movie)
-            RETURN DISTINCT p.name
-            ORDER BY p.name
-            """
-        ).values()
-        actors = [item for sublist in actors for item in sublist]
-    return render_template("media_filter.html", filter="actors", items=actors)
+async def choose_actors():
+    return render_stream(
+        "media_filter.html", filter="actors", items=streamed_values("actors")
+    )
 
 
 @app.route("/actors/media")
-def actors_media():
+@app.route("/actors/media.json", defaults={"as_json": True})
+async def actors_media(as_json=False):
     actor = unquote(request.args.get("actors"))
-    with neo.session() as session:
-        media = session.run(
-            """MATCH (p:Person {name: "%s"})-[:ACTED_IN]->(m:Movie)
-            RETURN {title: m.name, id: m.imdb_id, poster: m.poster, description: m.description, rating: m.imdb_rating}
-            ORDER BY m.imdb_rating DESC
-            """
-            % actor
-        ).values()
-        media = [item for sublist in media for item in sublist]
-    return render_template(
-        "media_list.html", filter=actor.capitalize(), media=media
+    return await media_page(
+        "actor_media", actor.capitalize(), as_json, name=actor
     )
 
 
 @app.route("/directors")
-def choose_directors():
-    with neo.session() as session:
-        directors = session.run(
-            """MATCH (p:Person)-[:DIRECTED]->(:Movie)
-            RETURN DISTINCT p.name
-            ORDER BY p.name
-            """
-        ).values()
-        directors = [item for sublist in directors for item in sublist]
-    return render_template(
-        "media_filter.html", filter="directors", items=directors
+async def choose_directors():
+    return render_stream(
+        "media_filter.html",
+        filter="directors",
+        items=streamed_values("directors"),
     )
 
 
 @app.route("/directors/media")
-def directors_media():
+@app.route("/directors/media.json", defaults={"as_json": True})
+async def directors_media(as_json=False):
     director = unquote(request.args.get("directors"))
-    with neo.session() as session:
-        media = session.run(
-            """MATCH (p:Person {name: "%s"})-[:DIRECTED]->(m:Movie)
-            RETURN {title: m.name, id: m.imdb_id, poster: m.poster, description: m.description, rating: m.imdb_rating}
-            ORDER BY m.imdb_rating DESC
-            """
-            % director
-        ).values()
-        media = [item for sublist in media for item in sublist]
-    return render_template(
-        "media_list.html", filter=director.capitalize(), media=media
+    return await media_page(
+        "director_media", director.capitalize(), as_json, name=director
     )
 
 
 @app.route("/categories/subcategories")
-def choose_subcategories():
-    with neo.session() as session:
-        subcategories = session.run(
-            """MATCH (c:Category)
-            WHERE NOT (c)<-[:HAS_SUBCATEGORY]-()
-            MATCH (c:Category)-[:HAS_MOVIE]->(m:Movie)
-            OPTIONAL MATCH (c)-[:HAS_SUBCATEGORY]->(sc:Category)
-            WITH c, sc, count(distinct m) as n
-            ORDER BY n DESC
-            RETURN {category: c.name, subcategories: collect(distinct sc.name), movies: n}
-            """
-        ).values()
-        subcategories = [item for sublist in subcategories for item in sublist]
-    return render_template("categories.html", subcategories=subcategories)
+async def choose_subcategories():
+    return render_stream(
+        "categories.html", subcategories=streamed_values("subcategories")
+    )
 
 
 @app.route("/categories")
-def choose_categories():
-    with neo.session() as session:
-        categories = session.run(
-            """MATCH (c:Category)
-            WHERE NOT (c)<-[:HAS_SUBCATEGORY]-()
-            RETURN DISTINCT c.name
-            ORDER BY c.name
-            """
-        ).values()
-        categories = [item for sublist in categories for item in sublist]
-    return render_template(
-        "media_filter.html", filter="categories", items=categories
+async def choose_categories():
+    return render_stream(
+        "media_filter.html",
+        filter="categories",
+        items=streamed_values("top_categories"),
     )
 
 
 @app.route("/categories/media")
-def categories_media():
+@app.route("/categories/media.json", defaults={"as_json": True})
+async def categories_media(as_json=False):
     category = unquote(request.args.get("categories"))
-    with neo.session() as session:
-        media = session.run(
-            """MATCH (c:Category {name: "%s"})-[:HAS_MOVIE]->(m:Movie)
-            RETURN {title: m.name, id: m.imdb_id, poster: m.poster, description: m.description, rating: m.imdb_rating}
-            ORDER BY m.imdb_rating DESC
-            """
-            % category
-        ).values()
-        media = [item for sublist in media for item in sublist]
-    return render_template("media_list.html", filter=category, media=media)
+    return await media_page("category_media", category, as_json, name=category)
 
 
 @app.route("/genres")
-def choose_genres():
-    with neo.session() as session:
-        genres = session.run(
-            """MATCH (g:Genre)
-            RETURN DISTINCT g.name
-            ORDER BY g.name
-            """
-        ).values()
-        genres = [item for sublist in genres for item in sublist]
-    return render_template("media_filter.html", filter="genres", items=genres)
+async def choose_genres():
+    return render_stream(
+        "media_filter.html", filter="genres", items=streamed_values("genres")
+    )
 
 
 @app.route("/genres/media")
-def genres_media():
+@app.route("/genres/media.json", defaults={"as_json": True})
+async def genres_media(as_json=False):
     genre = unquote(request.args.get("genres"))
-    with neo.session() as session:
-        media = session.run(
-            """MATCH (g:Genre {name: "%s"})-[:HAS_MOVIE]->(m:Movie)
-            RETURN {title: m.name, id: m.imdb_id, description: m.description, poster: m.poster, rating: m.imdb_rating}
-            ORDER BY m.imdb_rating DESC
-            """
-            % genre
-        ).values()
-        media = [item for sublist in media for item in sublist]
-    return render_template("media_list.html", filter=genre, media=media)
+    return await media_page("genre_media", genre, as_json, name=genre)
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import logging
+from typing import (
+    Any,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Optional,
+    Tuple,
+)
+
+import redis
+import redis.asyncio
+from metrics import CACHE_LOOKUPS
+
+log = logging.getLogger(__name__)
+
+# Bumped by the worker after every write to Neo4j
+GENERATION_KEY = "kotik:generation"
+CACHE_TTL = 24 * 3600
+MISSING = object()
+
+
+class QueryCache:
+    def __init__(self, url: str, ttl: int = CACHE_TTL):
+        self.client = redis.asyncio.Redis.from_url(url)
+        self.ttl = ttl
+
+    async def generation(self) -> Optional[int]:
+        try:
+            return int(await self.client.get(GENERATION_KEY) or 0)
+        except redis.exceptions.RedisError as err:
+            log.warning("Query cache unavailable: %s.", repr(err))
+            return None
+
+    async def lookup(
+        self, name: str, parameters: Dict[str, Any]
+    ) -> Tuple[str, Optional[int], Any]:
+        # The generation and the cached result are read in one round trip;
+        # a result stored under an older generation is a miss.
+        payload = json.dumps([name, parameters], sort_keys=True)
+        key = "kotik:api:" + hashlib.sha1(payload.encode()).hexdigest()
+        try:
+            generation, cached = await self.client.mget(GENERATION_KEY, key)
+        except redis.exceptions.RedisError as err:
+            log.warning("Query cache unavailable: %s.", repr(err))
+            CACHE_LOOKUPS.labels(name, "error").inc()
+            return key, None, MISSING
+
+        generation = int(generation or 0)
+        if cached is not None:
+            entry = json.loads(cached)
+            if entry["generation"] == generation:
+                CACHE_LOOKUPS.labels(name, "hit").inc()
+                return key, generation, entry["result"]
+
+        CACHE_LOOKUPS.labels(name, "miss").inc()
+        return key, generation, MISSING
+
+    async def store(self, key: str, generation: int, result: Any) -> None:
+        try:
+            await self.client.set(
+                key,
+                json.dumps({"generation": generation, "result": result}),
+                ex=self.ttl,
+            )
+        except redis.exceptions.RedisError as err:
+            log.warning("Query cache unavailable: %s.", repr(err))
+
+    async def get(
+        self,
+        name: str,
+        parameters: Dict[str, Any],
+        run: Callable[[], Awaitable[Any]],
+    ) -> Any:
+        key, generation, result = await self.lookup(name, parameters)
+        if result is MISSING:
+            result = await run()
+            if generation is not None:
+                await self.store(key, generation, result)
+        return result
+
+    async def stream(
+        self,
+        name: str,
+        parameters: Dict[str, Any],
+        run: Callable[[], AsyncIterator[Any]],
+    ) -> AsyncIterator[Any]:
+        # A miss is passed on item by item as it is read and only stored
+        # once it has been read to the end.
+        key, generation, result = await self.lookup(name, parameters)
+        if result is not MISSING:
+            for item in result:
+                yield item
+            return
+        result = []
+        async for item in run():
+            result.append(item)
+            yield item
+        if generation is not None:
+            await self.store(key, generation, result)
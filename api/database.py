@@ -0,0 +1,88 @@
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import neo4j
+import queries
+from metrics import QUERY_LATENCY
+from neo4j import AsyncGraphDatabase
+
+POOL_SIZE = 100
+ACQUISITION_TIMEOUT = 60.0
+FETCH_SIZE = 1000
+
+
+class Database:
+    # Records are pulled from Neo4j fetch_size at a time while they are
+    # consumed, so a long listing never has to be held in memory whole.
+    def __init__(
+        self,
+        url: str,
+        pool_size: int = POOL_SIZE,
+        acquisition_timeout: float = ACQUISITION_TIMEOUT,
+        fetch_size: int = FETCH_SIZE,
+    ):
+        self.url = url
+        self.pool_size = pool_size
+        self.acquisition_timeout = acquisition_timeout
+        self.fetch_size = fetch_size
+        self.driver: Optional[neo4j.AsyncDriver] = None
+
+    async def connect(self) -> None:
+        # The async driver belongs to the event loop that creates it
+        self.driver = AsyncGraphDatabase.driver(
+            self.url,
+            encrypted=False,
+            max_connection_pool_size=self.pool_size,
+            connection_acquisition_timeout=self.acquisition_timeout,
+        )
+
+    async def close(self) -> None:
+        if self.driver is not None:
+            await self.driver.close()
+            self.driver = None
+
+    def session(self) -> neo4j.AsyncSession:
+        if self.driver is None:
+            raise RuntimeError("The database is not connected.")
+        return self.driver.session(fetch_size=self.fetch_size)
+
+    async def records(
+        self, name: str, /, **parameters: Any
+    ) -> AsyncIterator[neo4j.Record]:
+        # Only the waits on Neo4j count towards the query latency, not the
+        # time the consumer spends between records
+        async with self.session() as session:
+            start = time.perf_counter()
+            result = await queries.run(name, session, **parameters)
+            elapsed = time.perf_counter() - start
+            try:
+                while True:
+                    start = time.perf_counter()
+                    record = await anext(result, None)
+                    elapsed += time.perf_counter() - start
+                    if record is None:
+                        break
+                    yield record
+            finally:
+                QUERY_LATENCY.labels(name).observe(elapsed)
+
+    async def column(
+        self, name: str, /, **parameters: Any
+    ) -> AsyncIterator[Any]:
+        async for record in self.records(name, **parameters):
+            yield record[0]
+
+    async def single(
+        self, name: str, /, **parameters: Any
+    ) -> Optional[neo4j.Record]:
+        async with self.session() as session:
+            with QUERY_LATENCY.labels(name).time():
+                result = await queries.run(name, session, **parameters)
+                return await result.single()
+
+    async def data(
+        self, name: str, /, **parameters: Any
+    ) -> List[Dict[str, Any]]:
+        return [
+            record.data() async for record in self.records(name, **parameters)
+        ]
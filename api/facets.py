@@ -0,0 +1,137 @@
+import asyncio
+import bisect
+import logging
+from collections import defaultdict
+from typing import (
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+
+log = logging.getLogger(__name__)
+
+FACETS = ["genres", "categories", "type", "year"]
+BLOCK_BITS = 4096
+BLOCK_MASK = (1 << BLOCK_BITS) - 1
+
+
+def bitset(positions: Iterable[int], size: int) -> int:
+    data = bytearray((size + 7) // 8)
+    for position in positions:
+        data[position >> 3] |= 1 << (position & 7)
+    return int.from_bytes(data, "little")
+
+
+class Facets:
+    # Movies are numbered by their place in the (rank DESC, id) order of
+    # the media pages, so every facet value is a bitset over those numbers
+    # and a filtered page is the lowest set bits of an intersection.
+    def __init__(self, rows: List[Dict[str, Any]], generation: Any):
+        rows = sorted(rows, key=lambda row: (-row["rank"], row["id"]))
+        self.generation = generation
+        self.size = len(rows)
+        self.ids = [row["id"] for row in rows]
+        self.ranks = [row["rank"] for row in rows]
+        self.keys = [(-row["rank"], row["id"]) for row in rows]
+        self.rated = bitset(
+            (i for i, row in enumerate(rows) if row["rating"] is not None),
+            self.size,
+        )
+
+        self.bits: Dict[str, Dict[Any, int]] = {}
+        for facet in FACETS:
+            positions = defaultdict(list)
+            for i, row in enumerate(rows):
+                values = row[facet]
+                if not isinstance(values, list):
+                    values = [values]
+                for value in values:
+                    if value is not None:
+                        positions[value].append(i)
+            self.bits[facet] = {
+                value: bitset(items, self.size)
+                for value, items in positions.items()
+            }
+
+    def match(self, **filters: Any) -> int:
+        masks: List[int] = []
+        for facet in FACETS:
+            values = filters.get(facet)
+            if values is None:
+                continue
+            if not isinstance(values, list):
+                values = [values]
+            masks.extend(self.bits[facet].get(value, 0) for value in values)
+        rating = filters.get("rating")
+        if rating is not None:
+            above = bisect.bisect_left(self.keys, (-rating,))
+            masks.append(self.rated & ((1 << above) - 1))
+        if not masks:
+            return (1 << self.size) - 1
+        selected = masks[0]
+        for mask in masks[1:]:
+            selected &= mask
+        return selected
+
+    def page(
+        self,
+        after: Optional[Dict[str, Any]],
+        limit: int,
+        **filters: Any,
+    ) -> List[Tuple[str, float]]:
+        start = 0
+        if after is not None:
+            start = bisect.bisect_right(
+                self.keys, (-after["rank"], after["id"])
+            )
+        selected = self.match(**filters) >> start
+        page: List[Tuple[str, float]] = []
+        # Bits are taken off a block at a time, as every operation on the
+        # whole bitset costs time proportional to its length
+        while selected and len(page) < limit:
+            block = selected & BLOCK_MASK
+            while block and len(page) < limit:
+                lowest = block & -block
+                position = start + lowest.bit_length() - 1
+                page.append((self.ids[position], self.ranks[position]))
+                block ^= lowest
+            selected >>= BLOCK_BITS
+            start += BLOCK_BITS
+        return page
+
+
+class FacetIndex:
+    def __init__(
+        self,
+        load: Callable[[], Awaitable[List[Dict[str, Any]]]],
+        generation: Callable[[], Awaitable[Any]],
+    ):
+        self.load = load
+        self.generation = generation
+        self.lock = asyncio.Lock()
+        self.facets: Optional[Facets] = None
+
+    async def get(self) -> Facets:
+        # Reloaded whenever the worker has bumped the data generation; while
+        # Redis is down the index that is already loaded is kept. Building
+        # the bitsets is CPU work, so it runs off the event loop.
+        generation = await self.generation()
+        facets = self.facets
+        if facets is not None and (
+            generation is None or facets.generation == generation
+        ):
+            return facets
+        async with self.lock:
+            # Another request may have reloaded it while this one waited
+            if self.facets is not None and self.facets is not facets:
+                return self.facets
+            rows = await self.load()
+            facets = await asyncio.to_thread(Facets, rows, generation)
+            self.facets = facets
+            log.info("Loaded facet index of %s movies.", facets.size)
+            return facets
@@ -0,0 +1,20 @@
+import os
+import shutil
+
+from prometheus_client import multiprocess
+
+# Every worker runs an event loop serving many requests at once
+worker_class = "uvicorn.workers.UvicornWorker"
+
+
+def on_starting(_server):
+    # Metrics files left by a previous run would be summed with the new ones
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+
+
+def child_exit(_server, worker):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(worker.pid)
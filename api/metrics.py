@@ -0,0 +1,82 @@
+import os
+import time
+from typing import AsyncIterator
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from quart import Quart, Response, g, request
+
+QUERY_LATENCY = Histogram(
+    "kotik_api_query_duration_seconds",
+    "Latency of Cypher statements, by statement name.",
+    ["statement"],
+)
+CACHE_LOOKUPS = Counter(
+    "kotik_api_query_cache_total",
+    "Query cache lookups, by statement name and result.",
+    ["statement", "result"],
+)
+ROUTE_LATENCY = Histogram(
+    "kotik_api_request_duration_seconds",
+    "Latency of API requests, by route, method and status.",
+    ["route", "method", "status"],
+)
+
+
+def instrument(app: Quart) -> None:
+    @app.before_request
+    async def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    async def observe_request(response):
+        start = g.pop("request_start", None)
+        if start is not None:
+            route = request.url_rule.rule if request.url_rule else "unmatched"
+            ROUTE_LATENCY.labels(
+                route, request.method, response.status_code
+            ).observe(time.perf_counter() - start)
+        return response
+
+
+def observe_stream(chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    # A streamed body is still being rendered when after_request runs, so
+    # its request is observed once the last chunk has been sent instead
+    start = g.pop("request_start", None)
+    route = request.url_rule.rule if request.url_rule else "unmatched"
+    method = request.method
+
+    async def observed():
+        status = 200
+        try:
+            async for chunk in chunks:
+                yield chunk
+        except Exception:
+            status = 500
+            raise
+        finally:
+            if start is not None:
+                ROUTE_LATENCY.labels(route, method, status).observe(
+                    time.perf_counter() - start
+                )
+
+    return observed()
+
+
+# Gunicorn runs several workers; with PROMETHEUS_MULTIPROC_DIR set each of
+# them writes its metrics there and any one of them serves the sum.
+def metrics_response() -> Response:
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(
+        generate_latest(registry), content_type=CONTENT_TYPE_LATEST
+    )
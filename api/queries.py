@@ -0,0 +1,151 @@
+# pylint: disable=line-too-long
+
+import re
+from typing import Any, Optional
+
+import neo4j
+
+MEDIA = "{title: m.name, id: m.imdb_id, poster: m.poster, description: m.description, rating: m.imdb_rating}"
+
+# Keyset pagination on (rating, imdb_id): a page starts right after the
+# $after cursor of the previous page and returns at most $limit rows.
+PAGE = f"""WITH m, coalesce(m.imdb_rating, -1.0) AS rank
+        WHERE $after IS NULL
+           OR rank < $after.rank
+           OR (rank = $after.rank AND m.imdb_id > $after.id)
+        RETURN {MEDIA} AS media, rank
+        ORDER BY rank DESC, m.imdb_id
+        LIMIT $limit"""
+
+# Every statement is a fixed text with $parameters, so Neo4j plans it once
+# and serves later executions from its query plan cache. The count of the
+# QUERY_LATENCY histogram tells how often each statement runs.
+STATEMENTS = {
+    "count": "MATCH (m:Movie) RETURN count(m.slug)",
+    "categories": """MATCH (c:Category)
+        RETURN DISTINCT c.name
+        ORDER BY c.name
+        """,
+    "top_categories": """MATCH (c:Category)
+        WHERE NOT (c)<-[:HAS_SUBCATEGORY]-()
+        RETURN DISTINCT c.name
+        ORDER BY c.name
+        """,
+    "subcategories": """MATCH (c:Category)
+        WHERE NOT (c)<-[:HAS_SUBCATEGORY]-()
+        MATCH (c:Category)-[:HAS_MOVIE]->(m:Movie)
+        OPTIONAL MATCH (c)-[:HAS_SUBCATEGORY]->(sc:Category)
+        WITH c, sc, count(distinct m) as n
+        ORDER BY n DESC
+        RETURN {category: c.name, subcategories: collect(distinct sc.name), movies: n}
+        """,
+    "genres": """MATCH (g:Genre)
+        RETURN DISTINCT g.name
+        ORDER BY g.name
+        """,
+    "actors": """MATCH (p:Person)-[:ACTED_IN]->(:Movie)
+        RETURN DISTINCT p.name
+        ORDER BY p.name
+        """,
+    "directors": """MATCH (p:Person)-[:DIRECTED]->(:Movie)
+        RETURN DISTINCT p.name
+        ORDER BY p.name
+        """,
+    "facets": """MATCH (m:Movie)
+        CALL {
+            WITH m
+            OPTIONAL MATCH (m)<-[:HAS_MOVIE]-(g:Genre)
+            RETURN collect(DISTINCT g.name) AS genres
+        }
+        CALL {
+            WITH m
+            OPTIONAL MATCH (m)<-[:HAS_MOVIE]-(c:Category)
+            RETURN collect(DISTINCT c.name) AS categories
+        }
+        RETURN m.imdb_id AS id, coalesce(m.imdb_rating, -1.0) AS rank, m.imdb_rating AS rating, m.type AS type, m.year AS year, genres, categories
+        """,
+    "media_by_ids": f"""MATCH (m:Movie)
+        WHERE m.imdb_id IN $ids
+        RETURN {MEDIA} AS media
+        """,
+    "best_media": """MATCH (m:Movie)
+        WHERE m[$rating] IS NOT NULL
+        WITH m, m[$rating] AS rank
+        WHERE $after IS NULL
+           OR rank < $after.rank
+           OR (rank = $after.rank AND m.imdb_id > $after.id)
+        RETURN {title: m.name, id: m.imdb_id, poster: m.poster, description: m.description, rating: rank} AS media, rank
+        ORDER BY rank DESC, m.imdb_id
+        LIMIT $limit
+        """,
+    "actor_media": f"""MATCH (p:Person {{name: $name}})-[:ACTED_IN]->(m:Movie)
+        {PAGE}
+        """,
+    "director_media": f"""MATCH (p:Person {{name: $name}})-[:DIRECTED]->(m:Movie)
+        {PAGE}
+        """,
+    "category_media": f"""MATCH (c:Category {{name: $name}})-[:HAS_MOVIE]->(m:Movie)
+        {PAGE}
+        """,
+    "genre_media": f"""MATCH (g:Genre {{name: $name}})-[:HAS_MOVIE]->(m:Movie)
+        {PAGE}
+        """,
+    "search_media": f"""CALL db.index.fulltext.queryNodes("media_text", $query)
+        YIELD node AS m, score
+        WITH m, score AS rank
+        WHERE $after IS NULL
+           OR rank < $after.rank
+           OR (rank = $after.rank AND m.imdb_id > $after.id)
+        RETURN {MEDIA} AS media, rank
+        ORDER BY rank DESC, m.imdb_id
+        LIMIT $limit
+        """,
+    "media_details": """MATCH (m:Movie {imdb_id: $id})
+        CALL {
+            WITH m
+            OPTIONAL MATCH (m)<-[:HAS_MOVIE]-(c:Category)
+            RETURN collect(DISTINCT c.name) AS categories
+        }
+        CALL {
+            WITH m
+            OPTIONAL MATCH (m)<-[:HAS_MOVIE]-(g:Genre)
+            RETURN collect(DISTINCT g.name) AS genres
+        }
+        CALL {
+            WITH m
+            MATCH (m)-[:SIMILAR]-(om:Movie)
+            WITH om
+            ORDER BY om.imdb_rating DESC
+            RETURN collect({id: om.imdb_id, title: om.name, poster: om.poster, description: om.description, rating: om.imdb_rating}) AS similar
+        }
+        RETURN m AS movie, categories, genres, similar
+        """,
+}
+
+# Shorter prefixes match too much of the catalog to be worth expanding
+MIN_PREFIX = 2
+
+
+def search_query(text: str) -> Optional[str]:
+    # Only word characters reach Lucene, so user input can't inject query
+    # syntax. Every word is required and the last one may be incomplete,
+    # unless it is too short to be a useful prefix yet; matches in the
+    # title rank higher than in the plot or description.
+    words = re.findall(r"\w+", text.lower())
+    if not words or len(words) == 1 and len(words[0]) < MIN_PREFIX:
+        return None
+    terms = [f"+{word}" for word in words[:-1]]
+    last = words[-1]
+    if len(last) >= MIN_PREFIX:
+        terms.append(f"+({last} {last}*)")
+        last = f"{last}*"
+    title = " ".join(words[:-1] + [last])
+    return f"{' '.join(terms)} name:({title})^2"
+
+
+async def run(
+    name: str, session: neo4j.AsyncSession, /, **parameters: Any
+) -> neo4j.AsyncResult:
+    # The latency, and with it the count of executions, is observed by the
+    # caller once the records are consumed
+    return await session.run(STATEMENTS[name], parameters)
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The API runs from its own directory and imports its modules by their flat
+# names, so the tests do the same
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
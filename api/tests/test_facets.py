@@ -0,0 +1,72 @@
+from facets import BLOCK_BITS, Facets
+
+
+def row(id_, rating, **facets):
+    return {
+        "id": id_,
+        "rank": -1.0 if rating is None else rating,
+        "rating": rating,
+        "type": facets.get("type", "movie"),
+        "year": facets.get("year", 2000),
+        "genres": facets.get("genres", []),
+        "categories": facets.get("categories", []),
+    }
+
+
+def test_rating_filter_is_strict_and_skips_unrated():
+    facets = Facets(
+        [
+            row("tt1", 7.0),
+            row("tt2", 7.1),
+            row("tt3", 6.9),
+            row("tt4", None),
+            row("tt5", 7.0),
+        ],
+        generation=1,
+    )
+    assert facets.page(None, 10, rating=7.0) == [("tt2", 7.1)]
+    assert facets.page(None, 10, rating=6.95) == [
+        ("tt2", 7.1),
+        ("tt1", 7.0),
+        ("tt5", 7.0),
+    ]
+    assert ("tt4", -1.0) not in facets.page(None, 10, rating=-2.0)
+
+
+def test_pages_resume_after_the_cursor():
+    # Ties on the rank are ordered by id, and the catalog spans several
+    # blocks of bits
+    rows = [
+        row(f"tt{i:05d}", float(i % 7), genres=["drama"] if i % 3 else [])
+        for i in range(2 * BLOCK_BITS + 50)
+    ]
+    facets = Facets(rows, generation=1)
+    everything = facets.page(None, len(rows), genres=["drama"])
+    assert len(everything) == sum(1 for r in rows if r["genres"])
+
+    pages, after = [], None
+    for _ in range(len(rows)):
+        page = facets.page(after, 1000, genres=["drama"])
+        if not page:
+            break
+        pages.extend(page)
+        after = {"id": page[-1][0], "rank": page[-1][1]}
+    assert pages == everything
+    assert everything == sorted(everything, key=lambda m: (-m[1], m[0]))
+
+
+def test_match_intersects_facets():
+    facets = Facets(
+        [
+            row("tt1", 8.0, genres=["drama", "war"], year=1999),
+            row("tt2", 7.0, genres=["drama"], year=1999),
+            row("tt3", 6.0, genres=["war"], categories=["history"]),
+        ],
+        generation=1,
+    )
+    assert facets.page(None, 10, genres=["drama", "war"]) == [("tt1", 8.0)]
+    assert facets.page(None, 10, year=1999, genres=["drama"]) == [
+        ("tt1", 8.0),
+        ("tt2", 7.0),
+    ]
+    assert facets.page(None, 10, categories=["missing"]) == []
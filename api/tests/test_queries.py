@@ -0,0 +1,31 @@
+import re
+
+import pytest
+from queries import search_query
+
+
+@pytest.mark.parametrize("text", ["", "   ", "a", "?!", "é"])
+def test_search_query_skips_short_input(text):
+    assert search_query(text) is None
+
+
+def test_search_query_requires_every_word_and_prefixes_the_last():
+    assert search_query("The Matri") == (
+        "+the +(matri matri*) name:(the matri*)^2"
+    )
+    assert search_query("Amélie") == "+(amélie amélie*) name:(amélie*)^2"
+
+
+def test_search_query_keeps_a_short_last_word_optional():
+    assert search_query("star w") == "+star name:(star w)^2"
+
+
+def test_search_query_strips_lucene_syntax():
+    query = search_query('title:"x" OR *:* AND -(y~2)^9 \\ NOT z')
+    words = "title x or and y 2 9 not z".split()
+    assert query == (
+        " ".join(f"+{word}" for word in words[:-1])
+        + " name:(title x or and y 2 9 not z)^2"
+    )
+    # Only the syntax search_query adds itself is left
+    assert re.fullmatch(r"[\w +()*:^]+", query)
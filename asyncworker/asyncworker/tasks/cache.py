@@ -0,0 +1,84 @@
+import hashlib
+import json
+import os
+import sqlite3
+from contextlib import closing
+from typing import Any, Dict, Tuple, Type, Union
+
+try:
+    import redis
+except ImportError:
+    redis = None  # type: ignore[assignment]
+
+CACHE_FORMAT = 1
+CACHE_TTL = 30 * 24 * 3600
+# Expired entries are kept this long so they can still be revalidated
+CACHE_KEEP = 180 * 24 * 3600
+
+
+def cache_key(url: str, params: Union[Dict[str, Any], None]) -> str:
+    payload = json.dumps([url, params or {}], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+class ResponseCache:
+    # Backend failures a caller can recover from by going upstream
+    errors: Tuple[Type[Exception], ...] = ()
+
+    def get(self, key: str) -> Union[Dict[str, Any], None]:
+        raise NotImplementedError
+
+    def set(self, key: str, entry: Dict[str, Any]) -> None:
+        raise NotImplementedError
+
+
+class SQLiteCache(ResponseCache):
+    errors = (sqlite3.Error,)
+
+    def __init__(self, path: str):
+        self.path = path
+        self.table = f"responses_v{CACHE_FORMAT}"
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} "
+            "(key TEXT PRIMARY KEY, entry TEXT NOT NULL)"
+        )
+        return connection
+
+    def get(self, key: str) -> Union[Dict[str, Any], None]:
+        with closing(self._connect()) as connection:
+            row = connection.execute(
+                f"SELECT entry FROM {self.table} WHERE key = ?", (key,)
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set(self, key: str, entry: Dict[str, Any]) -> None:
+        # The connection commits when the inner block ends and is closed
+        # by the outer one
+        with closing(self._connect()) as connection:
+            with connection:
+                connection.execute(
+                    f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?)",
+                    (key, json.dumps(entry)),
+                )
+
+
+class RedisCache(ResponseCache):
+    errors = (redis.exceptions.RedisError,) if redis is not None else ()
+
+    def __init__(self, url: str, keep: int = CACHE_KEEP):
+        if redis is None:
+            raise RuntimeError("redis is required for the redis cache.")
+        self.client = redis.Redis.from_url(url)
+        self.prefix = f"kotik:responses:v{CACHE_FORMAT}:"
+        self.keep = keep
+
+    def get(self, key: str) -> Union[Dict[str, Any], None]:
+        entry = self.client.get(self.prefix + key)
+        return json.loads(entry) if entry else None  # type: ignore[arg-type]
+
+    def set(self, key: str, entry: Dict[str, Any]) -> None:
+        self.client.set(self.prefix + key, json.dumps(entry), ex=self.keep)
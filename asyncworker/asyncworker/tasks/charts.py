@@ -0,0 +1,56 @@
+import hashlib
+import json
+import os
+import tempfile
+from math import pi
+from typing import Any, Dict
+
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+
+EMOTIONS = ["sadness", "anger", "joy", "disgust", "fear"]
+
+
+def chart_name(media: Dict[str, Any]) -> str:
+    # The API looks charts up by the same name and asks for the ones that
+    # are missing to be rendered
+    values = json.dumps([media[emotion] for emotion in EMOTIONS])
+    digest = hashlib.sha1(values.encode()).hexdigest()[:12]
+    return f'{media["slug"]}-{digest}.png'
+
+
+def emotions_chart(media: Dict[str, Any], folder: str) -> str:
+    filename = chart_name(media)
+    path = os.path.join(folder, filename)
+    if os.path.exists(path):
+        return filename
+
+    dimensions = len(EMOTIONS)
+
+    values = [media[emotion] for emotion in EMOTIONS]
+    values.append(values[0])
+
+    angles = [n / float(dimensions) * 2 * pi for n in range(dimensions)]
+    angles += angles[:1]
+
+    fig = Figure(figsize=(3, 3))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111, polar=True)
+    ax.set_xticks(angles[:-1])
+    ax.set_xticklabels(EMOTIONS, color="grey", size=12)
+    ax.set_rlabel_position(0)
+    ax.set_yticks([0.25, 0.5, 0.75])
+    ax.set_yticklabels(["0.25", "0.5", "0.75"], color="grey", size=8)
+    ax.set_ylim(0, 1)
+    ax.plot(angles, values, linewidth=1, linestyle="solid")
+    ax.fill(angles, values, "b", alpha=0.1)
+
+    fig.tight_layout()
+    with tempfile.NamedTemporaryFile(
+        dir=folder, suffix=".tmp", delete=False
+    ) as chart:
+        fig.savefig(chart, format="png")
+    os.chmod(chart.name, 0o644)
+    os.replace(chart.name, path)
+
+    return filename
@@ -1,54 +1,169 @@
 import json
+import os
 
+import redis
 from neo4j import GraphDatabase
 
+from asyncworker.tasks.cache import CACHE_TTL, RedisCache, SQLiteCache
 from asyncworker.tasks.datasource import (
+    COMPRESSION,
     IMDB,
+    KEEP_ALIVE,
+    POOL_SIZE,
+    PREFETCH_PAGES,
     IBMWatson,
     Mubi,
     Ororo,
     RottenTomatoes,
 )
+from asyncworker.tasks.ratelimit import MAX_WAIT, RateLimiter
+from asyncworker.tasks.similarity import (
+    ANN_CANDIDATES,
+    MEMORY_BUDGET_MB,
+    PROCESSES,
+    WRITE_BATCH_SIZE,
+    ModelStore,
+)
 
 with open("config.json") as f:
     config = json.load(f)
 
 
+def init_http_settings():
+    http_settings = {
+        "pool_size": POOL_SIZE,
+        "keep_alive": KEEP_ALIVE,
+        "compression": COMPRESSION,
+    }
+    http_settings.update(config.get("http", {}))
+    return http_settings
+
+
+def init_cache_settings(source):
+    cache_settings = {
+        "backend": "sqlite",
+        "path": os.path.join("cache", "responses.sqlite"),
+        "url": os.getenv("REDIS_URL", "redis://redis:6379"),
+        "ttl": {},
+    }
+    cache_settings.update(config.get("cache", {}))
+    if cache_settings["backend"] == "sqlite":
+        cache = SQLiteCache(path=cache_settings["path"])
+    elif cache_settings["backend"] == "redis":
+        cache = RedisCache(url=cache_settings["url"])
+    else:
+        cache = None
+    return {
+        "cache": cache,
+        "ttl": cache_settings["ttl"].get(source, CACHE_TTL),
+    }
+
+
+def init_rate_limit_settings(source):
+    rate_limit_settings = {
+        "url": os.getenv("REDIS_URL", "redis://redis:6379"),
+        "max_wait": MAX_WAIT,
+        "providers": {},
+    }
+    rate_limit_settings.update(config.get("rate_limits", {}))
+    quota = rate_limit_settings["providers"].get(source)
+    if quota is None:
+        return {"limiter": None}
+    limiter = RateLimiter(
+        url=rate_limit_settings["url"],
+        name=source,
+        rate=quota["rate"],
+        burst=quota.get("burst", 1),
+        max_wait=rate_limit_settings["max_wait"],
+    )
+    return {"limiter": limiter}
+
+
 def init_neo4j_client():
     neo = GraphDatabase.driver(config["neo4j"]["url"], encrypted=False)
     return neo
 
 
+def init_redis_client():
+    redis_client = redis.Redis.from_url(
+        os.getenv("REDIS_URL", "redis://redis:6379")
+    )
+    return redis_client
+
+
 def init_ororo_client():
     ororo = Ororo(
         url=config["ororo"]["url"],
         username=config["ororo"]["username"],
         password=config["ororo"]["password"],
+        **init_http_settings(),
+        **init_rate_limit_settings("ororo"),
     )
     return ororo
 
 
 def init_mubi_client():
-    mubi = Mubi(url=config["mubi"]["url"])
+    mubi = Mubi(
+        url=config["mubi"]["url"],
+        prefetch=config["mubi"].get("prefetch", PREFETCH_PAGES),
+        **init_http_settings(),
+        **init_rate_limit_settings("mubi"),
+    )
     return mubi
 
 
 def init_ibm_client():
     ibm_client = IBMWatson(
-        url=config["ibm"]["url"], api_key=config["ibm"]["apikey"]
+        url=config["ibm"]["url"],
+        api_key=config["ibm"]["apikey"],
+        **init_http_settings(),
+        **init_cache_settings("ibm"),
+        **init_rate_limit_settings("ibm"),
     )
     return ibm_client
 
 
 def init_rotten_tomatoes_client():
     rotten_tomatoes_client = RottenTomatoes(
-        url=config["rotten_tomatoes"]["url"]
+        url=config["rotten_tomatoes"]["url"],
+        **init_http_settings(),
+        **init_cache_settings("rotten_tomatoes"),
+        **init_rate_limit_settings("rotten_tomatoes"),
     )
     return rotten_tomatoes_client
 
 
 def init_imdb_client():
     imdb_client = IMDB(
-        url=config["imdb"]["url"], api_key=config["imdb"]["apikey"]
+        url=config["imdb"]["url"],
+        api_key=config["imdb"]["apikey"],
+        **init_http_settings(),
+        **init_cache_settings("imdb"),
+        **init_rate_limit_settings("imdb"),
     )
     return imdb_client
+
+
+def init_charts_dir():
+    charts_dir = config.get("charts_dir", os.path.join("static", "plots"))
+    os.makedirs(charts_dir, exist_ok=True)
+    return charts_dir
+
+
+def init_similarity_settings():
+    similarity_settings = {
+        "model_dir": "models",
+        "memory_budget_mb": MEMORY_BUDGET_MB,
+        "scratch_dir": None,
+        "processes": PROCESSES,
+        "ann": False,
+        "ann_candidates": ANN_CANDIDATES,
+        "write_batch_size": WRITE_BATCH_SIZE,
+    }
+    similarity_settings.update(config.get("similarity", {}))
+    return similarity_settings
+
+
+def init_model_store():
+    model_store = ModelStore(path=init_similarity_settings()["model_dir"])
+    return model_store
@@ -1,16 +1,40 @@
+import json
 import logging
-from typing import Any, Dict, Generator, Tuple, Union
+import os
+import time
+import unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import Any, Dict, Generator, List, Tuple, Union
 
 import requests
 from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 
+from asyncworker.tasks.cache import CACHE_TTL, ResponseCache, cache_key
+from asyncworker.tasks.jsonstream import stream_json
+from asyncworker.tasks.metrics import (
+    PROVIDER_CACHE,
+    PROVIDER_CONNECTIONS,
+    PROVIDER_RATE_LIMIT_WAIT,
+    observe_response,
+)
+from asyncworker.tasks.ratelimit import RateLimiter
+
 log = logging.getLogger(__name__)
 
+# 429 is left to the rate limiter: the adapter's retries would go out
+# without a token and overrun the quota
 retry_strategy = Retry(
-    total=3, backoff_factor=1, status_forcelist=[502, 503, 504, 429]
+    total=3, backoff_factor=1, status_forcelist=[502, 503, 504]
 )
-adapter = HTTPAdapter(max_retries=retry_strategy)
+
+POOL_SIZE = 10
+KEEP_ALIVE = True
+COMPRESSION = "gzip, deflate"
+PREFETCH_PAGES = 4
+STREAM_CHUNK_SIZE = 64 * 1024
 
 
 class DataSource:
@@ -18,39 +42,175 @@ class DataSource:
         self,
         url: str,
         auth: Union[None, Tuple[str, str]] = None,
+        pool_size: int = POOL_SIZE,
+        keep_alive: bool = KEEP_ALIVE,
+        compression: str = COMPRESSION,
+        cache: Union[ResponseCache, None] = None,
+        ttl: int = CACHE_TTL,
+        limiter: Union[RateLimiter, None] = None,
         **kwargs: Any,
     ):
         self.url = url
         self.auth = auth
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self.compression = compression
+        self.cache = cache
+        self.ttl = ttl
+        self.limiter = limiter
+        self.provider = type(self).__name__
         self.kwargs = kwargs
+        self._session: Union[requests.Session, None] = None
+        self._adapter: Union[HTTPAdapter, None] = None
+        self._pid: Union[int, None] = None
+        self._connections = 0
+
+    @property
+    def session(self) -> requests.Session:
+        # Connections must not be shared with a forked worker process, so a
+        # child that inherits the client opens a pool of its own.
+        if self._session is None or self._pid != os.getpid():
+            adapter = HTTPAdapter(
+                pool_connections=self.pool_size,
+                pool_maxsize=self.pool_size,
+                max_retries=retry_strategy,
+            )
+            session = requests.Session()
+            session.headers.update(self.kwargs.get("headers") or {})
+            session.headers["Accept-Encoding"] = self.compression
+            session.headers["Connection"] = (
+                "keep-alive" if self.keep_alive else "close"
+            )
+            session.auth = self.auth
+            session.hooks["response"].append(self._observe)
+            session.mount("https://", adapter)
+            session.mount("http://", adapter)
+            self._session = session
+            self._adapter = adapter
+            self._pid = os.getpid()
+            self._connections = 0
+            return session
+        return self._session
+
+    def close(self) -> None:
+        if self._session is not None and self._pid == os.getpid():
+            self._session.close()
+        self._session = None
+        self._adapter = None
+
+    def _observe(
+        self, response: requests.Response, *_args: Any, **_kwargs: Any
+    ) -> None:
+        observe_response(self.provider, response)
+        connections = 0
+        if self._adapter is not None:
+            for pool in self._adapter.poolmanager.pools.values():
+                connections += pool.num_connections
+        if connections > self._connections:
+            PROVIDER_CONNECTIONS.labels(self.provider).inc(
+                connections - self._connections
+            )
+        self._connections = connections
+
+    def throttle(self) -> None:
+        if self.limiter is not None:
+            start = time.perf_counter()
+            try:
+                self.limiter.acquire()
+            finally:
+                PROVIDER_RATE_LIMIT_WAIT.labels(self.provider).inc(
+                    time.perf_counter() - start
+                )
+
+    def cache_get(self, key: str) -> Union[Dict[str, Any], None]:
+        # The cache is best effort: while it is unavailable every request
+        # goes to the provider
+        if self.cache is None:
+            return None
+        try:
+            return self.cache.get(key)
+        except self.cache.errors as err:
+            log.warning("Response cache unavailable: %s.", repr(err))
+            return None
+
+    def cache_set(self, key: str, entry: Dict[str, Any]) -> None:
+        if self.cache is None:
+            return
+        try:
+            self.cache.set(key, entry)
+        except self.cache.errors as err:
+            log.warning("Response cache unavailable: %s.", repr(err))
+
+    def fetch(
+        self, url: str, params: Union[Dict[str, Any], None] = None
+    ) -> Any:
+        if self.cache is None:
+            self.throttle()
+            response = self.session.get(url, params=params)
+            response.raise_for_status()
+            return response.json()
+
+        key = cache_key(url, params)
+        entry = self.cache_get(key)
+        headers = {}
+        if entry is not None:
+            if entry["expires"] > time.time():
+                PROVIDER_CACHE.labels(self.provider, "hit").inc()
+                return json.loads(entry["body"])
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+
+        self.throttle()
+        response = self.session.get(url, params=params, headers=headers)
+        if entry is not None and response.status_code == 304:
+            PROVIDER_CACHE.labels(self.provider, "revalidated").inc()
+            entry["expires"] = time.time() + self.ttl
+            self.cache_set(key, entry)
+            return json.loads(entry["body"])
+        response.raise_for_status()
+
+        PROVIDER_CACHE.labels(self.provider, "miss").inc()
+        self.cache_set(
+            key,
+            {
+                "body": response.text,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "expires": time.time() + self.ttl,
+            },
+        )
+        return response.json()
 
     def get(
         self,
         params: Union[Dict[str, Any], None] = None,
         path: Union[str, None] = None,
     ) -> Generator[Dict[str, Any], None, None]:
-        headers = self.kwargs.get("headers")
+        url = f"{self.url}/{path}"
         try:
-            with requests.session() as session:
-                if headers:
-                    session.headers = headers
-                session.auth = self.auth
-                session.mount("https://", adapter)
-                session.mount("http://", adapter)
-
-                response = session.get(f"{self.url}/{path}", params=params)
-                response.raise_for_status()
-
-                if path and path in response.json().keys():
-                    result = response.json()[path]
-                else:
-                    result = response.json()
-
-                if isinstance(result, list):
-                    for item in result:
-                        yield item
-                else:
-                    yield result
+            if self.cache is None:
+                self.throttle()
+                response = self.session.get(url, params=params, stream=True)
+                # Closed on errors too, or the connection is never released
+                with closing(response):
+                    response.raise_for_status()
+                    yield from stream_json(
+                        response.iter_content(STREAM_CHUNK_SIZE), path
+                    )
+                return
+
+            result = self.fetch(url, params=params)
+
+            if path and isinstance(result, dict) and path in result:
+                result = result[path]
+
+            if isinstance(result, list):
+                for item in result:
+                    yield item
+            else:
+                yield result
 
         except requests.exceptions.HTTPError as http_err:
             log.error(http_err)
@@ -58,46 +218,70 @@ class DataSource:
 
 
 class Ororo(DataSource):
-    def __init__(self, url: str, username: str, password: str):
+    def __init__(self, url: str, username: str, password: str, **kwargs: Any):
         DataSource.__init__(
             self,
             url=url,
             auth=(username, password),
             headers={"User-Agent": "kotik"},
+            **kwargs,
         )
 
 
 class Mubi(DataSource):
+    def __init__(
+        self, url: str, prefetch: int = PREFETCH_PAGES, **kwargs: Any
+    ):
+        DataSource.__init__(self, url=url, **kwargs)
+        self.prefetch = prefetch
+
+    def _page(
+        self, session: requests.Session, path: Union[str, None], page: int
+    ) -> List[Dict[str, Any]]:
+        try:
+            self.throttle()
+            response = session.get(f"{self.url}/{path}", params={"page": page})
+            response.raise_for_status()
+        except requests.exceptions.HTTPError as http_err:
+            log.error(http_err)
+            raise
+        return response.json()
+
     def get(
         self,
         params: Union[Dict[str, Any], None] = None,
         path: Union[str, None] = None,
     ) -> Generator[Dict[str, Any], None, None]:
-        page = 1
-        while True:
-            try:
-                with requests.session() as session:
-                    session.mount("https://", adapter)
-                    session.mount("http://", adapter)
-
-                    params = {"page": page}
-                    response = session.get(f"{self.url}/{path}", params=params)
-                    response.raise_for_status()
-            except requests.exceptions.HTTPError as http_err:
-                log.error(http_err)
-                raise
-            if response.json():
-                page += 1
-                for movie in response.json():
-                    yield movie
-            else:
-                break
+        # Keep a window of page requests in flight and yield the pages in
+        # order; the pages requested past the first empty one are dropped.
+        session = self.session
+        executor = ThreadPoolExecutor(max_workers=self.prefetch)
+        try:
+            pending = deque(
+                executor.submit(self._page, session, path, page)
+                for page in range(1, self.prefetch + 1)
+            )
+            next_page = self.prefetch + 1
+            while pending:
+                movies = pending.popleft().result()
+                if not movies:
+                    break
+                pending.append(
+                    executor.submit(self._page, session, path, next_page)
+                )
+                next_page += 1
+                yield from movies
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
 
 
 class IMDB(DataSource):
-    def __init__(self, url: str, api_key: str):
+    def __init__(self, url: str, api_key: str, **kwargs: Any):
         DataSource.__init__(
-            self, url=f"{url}/?apikey={api_key}&plot=full&", auth=None
+            self,
+            url=f"{url}/?apikey={api_key}&plot=full&",
+            auth=None,
+            **kwargs,
         )
 
     def get_id(self, title: str, year: int) -> str:
@@ -106,13 +290,43 @@ class IMDB(DataSource):
 
 
 class IBMWatson(DataSource):
-    def __init__(self, url, api_key: str):
-        DataSource.__init__(self, url=url, auth=("apikey", api_key))
+    def __init__(self, url, api_key: str, **kwargs: Any):
+        DataSource.__init__(self, url=url, auth=("apikey", api_key), **kwargs)
+
+    def analyze(
+        self, text: str, features: str, version: str
+    ) -> Dict[str, Any]:
+        # Analyses are stored by normalized text, so the same film listed by
+        # several sources is only ever sent to Watson once.
+        text = " ".join(unicodedata.normalize("NFC", text).split())
+        features = ",".join(sorted(features.split(",")))
+        key = cache_key(
+            "analysis",
+            {"text": text, "features": features, "version": version},
+        )
+        if self.cache is not None:
+            entry = self.cache_get(key)
+            if entry is not None:
+                PROVIDER_CACHE.labels(self.provider, "hit").inc()
+                return entry["analysis"]
+
+        self.throttle()
+        response = self.session.get(
+            f"{self.url}/v1/analyze",
+            params={"version": version, "features": features, "text": text},
+        )
+        response.raise_for_status()
+        analysis = response.json()
+
+        if self.cache is not None:
+            PROVIDER_CACHE.labels(self.provider, "miss").inc()
+            self.cache_set(key, {"analysis": analysis})
+        return analysis
 
 
 class RottenTomatoes(DataSource):
-    def __init__(self, url: str):
-        DataSource.__init__(self, url=f"{url}/", auth=None)
+    def __init__(self, url: str, **kwargs: Any):
+        DataSource.__init__(self, url=f"{url}/", auth=None, **kwargs)
 
     def get(
         self,
@@ -121,35 +335,28 @@ class RottenTomatoes(DataSource):
     ) -> Generator[Dict[str, Any], None, None]:
 
         try:
-            with requests.session() as session:
-                session.mount("https://", adapter)
-                session.mount("http://", adapter)
-                response = session.get(f"{self.url}/v1.0/movies/{path}")
-                yield response.json()
+            yield self.fetch(f"{self.url}/v1.0/movies/{path}")
         except requests.exceptions.HTTPError as http_err:
             log.warning(http_err)
 
             if params:
                 try:
-                    with requests.session() as session:
-                        session.mount("https://", adapter)
-                        session.mount("http://", adapter)
-                        response = requests.get(
-                            f"{self.url}/v2.0/search",
-                            params={"q": params["title"], "type": "movies"},
+                    search = self.fetch(
+                        f"{self.url}/v2.0/search",
+                        params={"q": params["title"], "type": "movies"},
+                    )
+                    try:
+                        correct_path = search["movies"][0]["url"].split("/")[
+                            -1
+                        ]
+                    except IndexError:
+                        log.error(
+                            "Cannot find %s in Rotten Tomatoes.",
+                            params["title"],
                         )
-                        try:
-                            correct_path = response.json()["movies"][0][
-                                "url"
-                            ].split("/")[-1]
-                        except IndexError:
-                            log.error(
-                                "Cannot find %s in Rotten Tomatoes.",
-                                params["title"],
-                            )
-                            raise
-                        result = self.get(path=correct_path)
-                        yield from result
+                        raise
+                    result = self.get(path=correct_path)
+                    yield from result
                 except requests.exceptions.HTTPError as http_err:
                     log.error(http_err)
                     raise
@@ -0,0 +1,114 @@
+import codecs
+import json
+from typing import Any, Generator, Iterator, Union
+
+WHITESPACE = " \t\n\r"
+NUMBER = set("0123456789+-.eE")
+
+
+class JSONStream:
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = iter(chunks)
+        self.decoder = json.JSONDecoder()
+        self.text = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.position = 0
+
+    def _read(self) -> bool:
+        for chunk in self.chunks:
+            text = self.text.decode(chunk)
+            if text:
+                # Drop everything that was already parsed
+                self.buffer = self.buffer[self.position :] + text
+                self.position = 0
+                return True
+        return False
+
+    def peek(self) -> str:
+        while True:
+            while (
+                self.position < len(self.buffer)
+                and self.buffer[self.position] in WHITESPACE
+            ):
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read():
+                raise ValueError("Unexpected end of JSON document.")
+
+    def expect(self, char: str) -> None:
+        if self.peek() != char:
+            raise ValueError(
+                f"Expected {char!r} at {self.position} of JSON document."
+            )
+        self.position += 1
+
+    def value(self) -> Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(
+                    self.buffer, self.position
+                )
+            except json.JSONDecodeError:
+                if not self._read():
+                    raise
+                continue
+            # A number is only complete once something else follows it
+            if (
+                isinstance(value, (int, float))
+                and not isinstance(value, bool)
+                and NUMBER.issuperset(self.buffer[end:])
+                and self._read()
+            ):
+                continue
+            self.position = end
+            return value
+
+    def items(self) -> Generator[Any, None, None]:
+        self.expect("[")
+        if self.peek() == "]":
+            self.position += 1
+            return
+        while True:
+            yield self.value()
+            char = self.peek()
+            self.position += 1
+            if char == "]":
+                return
+            if char != ",":
+                raise ValueError(
+                    f"Expected ',' at {self.position} of JSON document."
+                )
+
+
+def stream_json(
+    chunks: Iterator[bytes], key: Union[str, None] = None
+) -> Generator[Any, None, None]:
+    # Yields the items of the top-level array, or of the array under `key`
+    # in the top-level object, while the body is still being downloaded.
+    # Anything else is yielded whole, like DataSource.get always did.
+    stream = JSONStream(chunks)
+    char = stream.peek()
+    if char == "[":
+        yield from stream.items()
+        return
+    if char != "{" or not key:
+        yield stream.value()
+        return
+
+    stream.expect("{")
+    members = {}
+    while stream.peek() != "}":
+        name = stream.value()
+        stream.expect(":")
+        if name == key:
+            if stream.peek() == "[":
+                yield from stream.items()
+            else:
+                yield stream.value()
+            return
+        members[name] = stream.value()
+        if stream.peek() == ",":
+            stream.position += 1
+    yield members
@@ -0,0 +1,127 @@
+import logging
+import os
+import shutil
+import time
+from typing import Any, Dict
+
+from celery import signals
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    multiprocess,
+    start_http_server,
+)
+
+log = logging.getLogger(__name__)
+
+METRICS_PORT = 9100
+TASK_BUCKETS = (0.1, 0.5, 1, 5, 15, 60, 300, 900, 1800, 3600, 7200)
+
+QUERY_LATENCY = Histogram(
+    "kotik_worker_query_duration_seconds",
+    "Latency of Cypher statements, by statement name.",
+    ["statement"],
+)
+QUERY_RETRIES = Counter(
+    "kotik_worker_query_retries_total",
+    "Cypher statements retried after a transient error.",
+    ["statement"],
+)
+PROVIDER_LATENCY = Histogram(
+    "kotik_provider_request_duration_seconds",
+    "Latency of data provider requests, by provider.",
+    ["provider"],
+)
+PROVIDER_RETRIES = Counter(
+    "kotik_provider_retries_total",
+    "Data provider requests retried by the HTTP adapter.",
+    ["provider"],
+)
+PROVIDER_RATE_LIMIT_WAIT = Counter(
+    "kotik_provider_rate_limit_wait_seconds_total",
+    "Time spent waiting for a data provider's rate limit.",
+    ["provider"],
+)
+PROVIDER_CONNECTIONS = Counter(
+    "kotik_provider_connections_total",
+    "Connections opened to data providers; the requests counted by "
+    "kotik_provider_request_duration_seconds reuse them.",
+    ["provider"],
+)
+PROVIDER_CACHE = Counter(
+    "kotik_provider_cache_total",
+    "Response cache lookups before data provider requests, by result.",
+    ["provider", "result"],
+)
+PROVIDER_RATE_LIMIT = Counter(
+    "kotik_provider_rate_limit_total",
+    "Rate limit checks before data provider requests, by result.",
+    ["provider", "result"],
+)
+TASK_LATENCY = Histogram(
+    "kotik_task_duration_seconds",
+    "Run time of Celery tasks, by task name and final state.",
+    ["task", "state"],
+    buckets=TASK_BUCKETS,
+)
+TASK_RETRIES = Counter(
+    "kotik_task_retries_total",
+    "Celery tasks scheduled for a retry.",
+    ["task"],
+)
+
+_task_starts: Dict[str, float] = {}
+
+
+def observe_response(provider: str, response: Any) -> None:
+    PROVIDER_LATENCY.labels(provider).observe(response.elapsed.total_seconds())
+    retries = getattr(response.raw, "retries", None)
+    if retries is not None and retries.history:
+        PROVIDER_RETRIES.labels(provider).inc(len(retries.history))
+
+
+@signals.task_prerun.connect
+def task_started(task_id: str, **_kwargs: Any) -> None:
+    _task_starts[task_id] = time.perf_counter()
+
+
+@signals.task_postrun.connect
+def task_finished(task_id: str, task: Any, state: str, **_kwargs: Any) -> None:
+    start = _task_starts.pop(task_id, None)
+    if start is not None:
+        TASK_LATENCY.labels(task.name, state or "UNKNOWN").observe(
+            time.perf_counter() - start
+        )
+
+
+@signals.task_retry.connect
+def task_retried(sender: Any, **_kwargs: Any) -> None:
+    TASK_RETRIES.labels(sender.name).inc()
+
+
+# The prefork pool records metrics in its child processes. With
+# PROMETHEUS_MULTIPROC_DIR set every child writes to its own files there and
+# the main process serves their sum; without it only the main process'
+# metrics are visible.
+@signals.worker_init.connect
+def serve_metrics(**_kwargs: Any) -> None:
+    port = int(os.getenv("METRICS_PORT", str(METRICS_PORT)))
+    if not port:
+        return
+    directory = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    registry = REGISTRY
+    if directory:
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory)
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
+    log.info("Serving metrics on port %s.", port)
+
+
+@signals.worker_process_shutdown.connect
+def process_stopped(pid: int, **_kwargs: Any) -> None:
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
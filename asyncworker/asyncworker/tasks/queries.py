@@ -0,0 +1,184 @@
+import logging
+import time
+from typing import Any, Dict, List
+
+import neo4j
+import neo4j.exceptions
+
+from asyncworker.tasks.metrics import QUERY_LATENCY, QUERY_RETRIES
+
+log = logging.getLogger(__name__)
+
+# Every statement is a fixed text with $parameters, so Neo4j plans it once
+# and serves later executions from its query plan cache. The count of the
+# QUERY_LATENCY histogram tells how often each statement runs.
+STATEMENTS = {
+    # Schema
+    "movie_id_constraint": """CREATE CONSTRAINT movie_imdb_id IF NOT EXISTS
+        FOR (m:Movie) REQUIRE m.imdb_id IS UNIQUE
+        """,
+    "movie_slug_index": (
+        "CREATE INDEX movie_slug IF NOT EXISTS FOR (m:Movie) ON (m.slug)"
+    ),
+    "genre_name_constraint": """CREATE CONSTRAINT genre_name IF NOT EXISTS
+        FOR (g:Genre) REQUIRE g.name IS UNIQUE
+        """,
+    "category_name_constraint": """CREATE CONSTRAINT category_name
+        IF NOT EXISTS FOR (c:Category) REQUIRE c.name IS UNIQUE
+        """,
+    "person_name_constraint": """CREATE CONSTRAINT person_name IF NOT EXISTS
+        FOR (p:Person) REQUIRE p.name IS UNIQUE
+        """,
+    # Searched by the API's /media/search
+    "media_text_index": """CREATE FULLTEXT INDEX media_text IF NOT EXISTS
+        FOR (m:Movie) ON EACH [m.name, m.description, m.plot]
+        """,
+    # Media
+    "existing_movies": """UNWIND $rows AS row
+        MATCH (m: Movie {imdb_id: row.imdb_id, slug: row.slug})
+        RETURN m.imdb_id AS imdb_id, m.imdb_data AS imdb_data
+        """,
+    "create_movies": """UNWIND $rows AS row
+        MERGE (m: Movie {imdb_id: row.imdb_id})
+        ON CREATE SET m += row.properties
+        """,
+    "link_movie_genres": """UNWIND $rows AS row
+        MATCH (m: Movie {imdb_id: row.imdb_id})
+        UNWIND row.genres AS genre
+        MERGE (g: Genre {name: genre})
+        MERGE (g)-[:HAS_MOVIE]->(m)
+        """,
+    "link_movie_countries": """UNWIND $rows AS row
+        MATCH (m: Movie {imdb_id: row.imdb_id})
+        UNWIND row.countries AS country
+        MERGE (c: Country {name: country})
+        MERGE (c)-[:HAS_MOVIE]->(m)
+        """,
+    "set_movie_properties": """MATCH (m: Movie {imdb_id: $imdb_id})
+        SET m += $properties
+        """,
+    # IMDB
+    "imdb_flag": """MATCH (m: Movie {imdb_id: $imdb_id})
+        RETURN m.imdb_data
+        """,
+    "link_genres": """MATCH (m: Movie {imdb_id: $imdb_id})
+        UNWIND $names AS name
+        MERGE (g: Genre {name: name})
+        MERGE (g)-[:HAS_MOVIE]->(m)
+        """,
+    "link_actors": """MATCH (m: Movie {imdb_id: $imdb_id})
+        UNWIND $names AS name
+        MERGE (p: Person {name: name})
+        MERGE (p)-[:ACTED_IN]->(m)
+        """,
+    "link_directors": """MATCH (m: Movie {imdb_id: $imdb_id})
+        UNWIND $names AS name
+        MERGE (p: Person {name: name})
+        MERGE (p)-[:DIRECTED]->(m)
+        """,
+    # Rotten Tomatoes
+    "rotten_tomatoes_flag": """MATCH (m: Movie {imdb_id: $imdb_id})
+        RETURN m.rotten_tomatoes_data, m.slug, m.name
+        """,
+    # IBM Watson
+    "ibm_texts": """MATCH (m: Movie {imdb_id: $imdb_id})
+        RETURN m.ibm_data, m.plot, m.description,
+               m.synopsis, m.reviews, m.consensus
+        """,
+    "merge_category": "MERGE (c:Category {name: $name})",
+    "link_subcategories": """UNWIND $pairs AS pair
+        MATCH (n:Category {name: pair.parent})
+        MERGE (c:Category {name: pair.child})
+        MERGE (n)-[:HAS_SUBCATEGORY]->(c)
+        """,
+    "link_categories": """MATCH (m:Movie {imdb_id: $imdb_id})
+        SET m.ibm_data = true
+        WITH m
+        UNWIND $names AS name
+        MERGE (c:Category {name: name})
+        MERGE (c)-[r:HAS_MOVIE]->(m)
+        SET r.score = $score
+        """,
+    "emotions": """MATCH (m:Movie)
+        WHERE ($imdb_ids IS NULL OR m.imdb_id IN $imdb_ids)
+          AND all(emotion IN [m.sadness, m.anger, m.joy, m.disgust, m.fear]
+                  WHERE emotion IS NOT NULL)
+        RETURN m.slug AS slug, m.sadness AS sadness, m.anger AS anger,
+               m.joy AS joy, m.disgust AS disgust, m.fear AS fear
+        """,
+    # Similarities
+    "movies_with_labels": """MATCH (m:Movie)
+        OPTIONAL MATCH (g:Genre)-[:HAS_MOVIE]->(m)
+        OPTIONAL MATCH (c:Category)-[:HAS_MOVIE]->(m)
+        WITH m,
+             collect(distinct g.name) as genres,
+             collect(distinct c.name) as categories
+        RETURN m as movie, genres, categories
+        """,
+    "delete_similarities": "MATCH (:Movie)-[r:SIMILAR]-(:Movie) DELETE r",
+    "delete_movie_similarities": """UNWIND $rows AS slug
+        MATCH (:Movie {slug: slug})-[r:SIMILAR]-(:Movie)
+        DELETE r
+        """,
+    "write_similarities": """UNWIND $rows AS row
+        MATCH (m:Movie {slug: row.source})
+        MATCH (sm:Movie {slug: row.target})
+        MERGE (m)-[r:SIMILAR]-(sm)
+        SET r.similarity = row.similarity
+        """,
+}
+
+SCHEMA = [
+    "movie_id_constraint",
+    "movie_slug_index",
+    "genre_name_constraint",
+    "category_name_constraint",
+    "person_name_constraint",
+    "media_text_index",
+]
+
+
+def run(
+    name: str, session: neo4j.Session, /, **parameters: Any
+) -> List[Dict[str, Any]]:
+    # Records are fetched before returning, so the latency covers the whole
+    # statement and errors raised while it streams are handled here too
+    query = STATEMENTS[name]
+    retries = 0
+    while retries <= 3:
+        try:
+            with QUERY_LATENCY.labels(name).time():
+                records = session.run(query, parameters).data()
+            return records
+        except neo4j.exceptions.TransientError as err:
+            wait = retries * 5
+            log.warning(
+                "Transient error in %s, retrying in %ss: %s.", name, wait, err
+            )
+            QUERY_RETRIES.labels(name).inc()
+            time.sleep(wait)
+            retries += 1
+        except neo4j.exceptions.ConstraintError:
+            log.warning("Item already exists: %s %s.", name, parameters)
+            return []
+    raise RuntimeError
+
+
+def _run_batch(
+    transaction: neo4j.ManagedTransaction, query: str, rows: List[Any]
+) -> None:
+    transaction.run(query, rows=rows).consume()
+
+
+def run_batches(
+    name: str, rows: List[Any], session: neo4j.Session, batch_size: int
+) -> None:
+    # Every batch is sent as the $rows parameter of an UNWIND statement in
+    # its own write transaction, which the driver retries on transient
+    # errors.
+    query = STATEMENTS[name]
+    for start in range(0, len(rows), batch_size):
+        with QUERY_LATENCY.labels(name).time():
+            session.execute_write(
+                _run_batch, query, rows[start : start + batch_size]
+            )
@@ -0,0 +1,85 @@
+import time
+
+try:
+    import redis
+except ImportError:
+    redis = None  # type: ignore[assignment]
+
+from asyncworker.tasks.metrics import PROVIDER_RATE_LIMIT
+
+MAX_WAIT = 30.0
+
+# Reserves one token from the bucket, refilled at `rate` tokens per second
+# up to `burst`. The bucket may go negative, so concurrent callers queue up
+# behind each other; a caller that would wait longer than `max_wait` takes
+# nothing. Redis' own clock is used so every worker sees the same time.
+TOKEN_BUCKET = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local max_wait = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'timestamp')
+local tokens = tonumber(state[1]) or burst
+local timestamp = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - timestamp) * rate)
+local wait = 0
+if tokens < 1 then
+    wait = (1 - tokens) / rate
+end
+local granted = 0
+if wait <= max_wait then
+    tokens = tokens - 1
+    granted = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'timestamp', now)
+redis.call('EXPIRE', KEYS[1], math.ceil((burst + max_wait * rate) / rate) + 1)
+return {granted, tostring(wait)}
+"""
+
+
+class RateLimitExceeded(Exception):
+    pass
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        url: str,
+        name: str,
+        rate: float,
+        burst: int = 1,
+        max_wait: float = MAX_WAIT,
+    ):
+        if redis is None:
+            raise RuntimeError("redis is required for rate limiting.")
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(TOKEN_BUCKET)
+        self.key = f"kotik:ratelimit:{name}"
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_wait = max_wait
+
+    def acquire(self) -> None:
+        # Without Redis the quota cannot be checked, so the request is not
+        # made and the task retries later rather than overrunning it
+        try:
+            granted, wait = self.script(
+                keys=[self.key], args=[self.rate, self.burst, self.max_wait]
+            )
+        except redis.exceptions.RedisError as err:
+            PROVIDER_RATE_LIMIT.labels(self.name, "unavailable").inc()
+            raise RateLimitExceeded(
+                f"Cannot check the {self.name} rate limit: {err!r}."
+            ) from err
+        wait = float(wait)
+        if not granted:
+            PROVIDER_RATE_LIMIT.labels(self.name, "rejected").inc()
+            raise RateLimitExceeded(
+                f"{self.name} is rate limited for another {wait:.2f}s."
+            )
+        if wait > 0:
+            time.sleep(wait)
+            PROVIDER_RATE_LIMIT.labels(self.name, "delayed").inc()
+        PROVIDER_RATE_LIMIT.labels(self.name, "acquired").inc()
@@ -0,0 +1,748 @@
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+from collections import defaultdict
+from contextlib import closing, contextmanager
+from datetime import datetime
+from functools import lru_cache
+from typing import (
+    Any,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Tuple,
+    Union,
+)
+
+import gensim
+import numpy as np
+from billiard.pool import Pool
+from nltk.corpus import stopwords
+from nltk.stem.snowball import SnowballStemmer
+from nltk.tokenize import RegexpTokenizer
+
+from asyncworker.tasks import utils
+
+try:
+    import hnswlib
+except ImportError:  # pragma: no cover
+    hnswlib = None
+
+log = logging.getLogger(__name__)
+
+NUM_NEIGHBOURS = 10
+SIMILARITY_THRESHOLD = 0.25
+TEXT_WEIGHT = 0.25
+CORRELATION_WEIGHT = 0.75
+# Above this share of new, changed or removed movies in one run, or of
+# movies folded in since the models were last fitted, the folded-in model is
+# too far from a fresh fit, and an incremental run falls back to a full one.
+MAX_CHANGED_RATIO = 0.2
+
+# Bump these whenever the stored layout or the tokenization changes, so that
+# stale artifacts are ignored instead of being mixed with new ones.
+MODEL_FORMAT = 2
+TOKENS_FORMAT = 1
+KEEP_VERSIONS = 3
+
+PROCESSES = os.cpu_count() or 1
+TOKENIZE_CHUNK_SIZE = 256
+STEM_CACHE_SIZE = 2**18
+
+MEMORY_BUDGET_MB = 512
+# Bytes held per row of a block: the text and correlation scores, their
+# blend and the partial selection scratch, each N wide.
+ROW_BYTES = 48
+ANN_CANDIDATES = 100
+WRITE_BATCH_SIZE = 5000
+
+tokenizer = RegexpTokenizer(r"\w+")
+stemmer = SnowballStemmer("english")
+
+# Seconds spent in each stage of the current similarity run
+timings: DefaultDict[str, float] = defaultdict(float)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[name] += time.perf_counter() - start
+
+
+def timed(items: Iterable[Any], name: str) -> Iterator[Any]:
+    # Charges the time spent producing every item of a lazy stream to a stage
+    iterator = iter(items)
+    while True:
+        with stage(name):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+def movie_text(movie: Dict[str, Any]) -> str:
+    text_list = []
+    for key in utils.TEXT_KEYS:
+        if movie.get(key) and isinstance(movie[key], str):
+            text_list.append(movie[key].lower())
+    return ". ".join(text_list)
+
+
+@lru_cache(maxsize=STEM_CACHE_SIZE)
+def stem(word: str) -> str:
+    return stemmer.stem(word)
+
+
+def tokenize(text: str) -> List[str]:
+    return [stem(word) for word in tokenizer.tokenize(text)]
+
+
+def _tokenize_chunk(texts: List[str]) -> List[List[str]]:
+    return [tokenize(text) for text in texts]
+
+
+def tokenize_many(
+    texts: List[str],
+    processes: int = PROCESSES,
+    chunk_size: int = TOKENIZE_CHUNK_SIZE,
+) -> Iterator[List[str]]:
+    # Chunks are tokenized by a process pool, each worker with its own stem
+    # cache, and come back in the order of the texts. The pool is billiard's,
+    # since Celery's prefork children are daemons and the standard library
+    # does not let a daemon start processes.
+    if processes <= 1 or len(texts) <= chunk_size:
+        yield from _tokenize_chunk(texts)
+        return
+    chunks = [
+        texts[start : start + chunk_size]
+        for start in range(0, len(texts), chunk_size)
+    ]
+    pool = Pool(processes=min(processes, len(chunks)))
+    try:
+        for chunk in pool.imap(_tokenize_chunk, chunks):
+            yield from chunk
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def content_hash(values: Any) -> str:
+    serialized = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(serialized.encode("utf-8")).hexdigest()
+
+
+def text_hash(movie: Dict[str, Any]) -> str:
+    return content_hash([movie.get(key) for key in utils.TEXT_KEYS])
+
+
+def feature_hash(record: Dict[str, Any]) -> str:
+    movie = record["movie"]
+    return content_hash(
+        [
+            [movie.get(key) for key in utils.FEATURE_KEYS],
+            sorted(record["genres"]),
+            sorted(record["categories"]),
+        ]
+    )
+
+
+class SimilarityModel:  # pylint: disable=too-many-instance-attributes
+    def __init__(  # pylint: disable=too-many-arguments
+        self,
+        dictionary: gensim.corpora.Dictionary,
+        tfidf: gensim.models.TfidfModel,
+        lsi: gensim.models.LsiModel,
+        slugs: List[str],
+        text_hashes: List[str],
+        feature_hashes: List[str],
+        vectors: np.ndarray,
+        neighbour_ids: np.ndarray,
+        neighbour_scores: np.ndarray,
+        folded: int,
+    ):
+        self.dictionary = dictionary
+        self.tfidf = tfidf
+        self.lsi = lsi
+        self.slugs = slugs
+        self.text_hashes = text_hashes
+        self.feature_hashes = feature_hashes
+        self.vectors = vectors
+        self.neighbour_ids = neighbour_ids
+        self.neighbour_scores = neighbour_scores
+        # Documents folded into the models since they were last fitted
+        self.folded = folded
+
+
+class TokenCache:
+    def __init__(self, path: str):
+        self.path = path
+        self.table = f"tokens_v{TOKENS_FORMAT}"
+
+    def _connect(self) -> sqlite3.Connection:
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        connection = sqlite3.connect(self.path)
+        connection.execute(
+            f"CREATE TABLE IF NOT EXISTS {self.table} "
+            "(key TEXT PRIMARY KEY, tokens TEXT NOT NULL)"
+        )
+        return connection
+
+    def get(self, keys: List[str]) -> Dict[str, List[str]]:
+        keys = list(set(keys))
+        streams = {}
+        with closing(self._connect()) as connection:
+            for start in range(0, len(keys), 500):
+                chunk = keys[start : start + 500]
+                placeholders = ",".join("?" * len(chunk))
+                rows = connection.execute(
+                    f"SELECT key, tokens FROM {self.table} "
+                    f"WHERE key IN ({placeholders})",
+                    chunk,
+                )
+                for key, tokens in rows:
+                    streams[key] = tokens.split()
+        return streams
+
+    def put(self, streams: Dict[str, List[str]]) -> None:
+        if not streams:
+            return
+        # The connection commits when the inner block ends and is closed
+        # by the outer one
+        with closing(self._connect()) as connection:
+            with connection:
+                connection.executemany(
+                    f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?)",
+                    (
+                        (key, " ".join(tokens))
+                        for key, tokens in streams.items()
+                    ),
+                )
+
+
+class ModelStore:
+    def __init__(self, path: str, keep: int = KEEP_VERSIONS):
+        self.path = path
+        self.keep = keep
+        self.token_cache = TokenCache(os.path.join(path, "tokens.sqlite"))
+
+    def _file(self, version: str, name: str) -> str:
+        return os.path.join(self.path, "versions", version, name)
+
+    def current(self) -> Union[str, None]:
+        try:
+            with open(
+                os.path.join(self.path, "CURRENT"), encoding="utf-8"
+            ) as handle:
+                return handle.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def load(self) -> Union[SimilarityModel, None]:
+        version = self.current()
+        if version is None:
+            return None
+        try:
+            state = np.load(self._file(version, "state.npz"))
+            if int(state["format"]) != MODEL_FORMAT:
+                log.info("Similarity model %s is outdated.", version)
+                return None
+            return SimilarityModel(
+                dictionary=gensim.corpora.Dictionary.load(
+                    self._file(version, "dictionary")
+                ),
+                tfidf=gensim.models.TfidfModel.load(
+                    self._file(version, "tfidf")
+                ),
+                lsi=gensim.models.LsiModel.load(self._file(version, "lsi")),
+                slugs=state["slugs"].tolist(),
+                text_hashes=state["text_hashes"].tolist(),
+                feature_hashes=state["feature_hashes"].tolist(),
+                vectors=state["vectors"],
+                neighbour_ids=state["neighbour_ids"],
+                neighbour_scores=state["neighbour_scores"],
+                folded=int(state["folded"]),
+            )
+        except (OSError, ValueError, KeyError) as err:
+            log.warning(
+                "Cannot load similarity model %s: %s.", version, repr(err)
+            )
+            return None
+
+    def save(self, model: SimilarityModel) -> str:
+        version = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        os.makedirs(os.path.dirname(self._file(version, "")), exist_ok=True)
+
+        model.dictionary.save(self._file(version, "dictionary"))
+        model.tfidf.save(self._file(version, "tfidf"))
+        model.lsi.save(self._file(version, "lsi"))
+        with open(self._file(version, "state.npz"), "wb") as handle:
+            np.savez(
+                handle,
+                format=MODEL_FORMAT,
+                slugs=np.array(model.slugs, dtype=str),
+                text_hashes=np.array(model.text_hashes, dtype=str),
+                feature_hashes=np.array(model.feature_hashes, dtype=str),
+                vectors=model.vectors,
+                neighbour_ids=model.neighbour_ids,
+                neighbour_scores=model.neighbour_scores,
+                folded=model.folded,
+            )
+
+        # Readers only ever see complete versions: CURRENT is switched
+        # atomically once every file of the new version is on disk.
+        with open(
+            os.path.join(self.path, "CURRENT.tmp"), "w", encoding="utf-8"
+        ) as handle:
+            handle.write(version)
+        os.replace(
+            os.path.join(self.path, "CURRENT.tmp"),
+            os.path.join(self.path, "CURRENT"),
+        )
+        log.info("Saved similarity model %s.", version)
+
+        versions = sorted(os.listdir(os.path.join(self.path, "versions")))
+        for old in versions[: -self.keep]:
+            if old != version:
+                shutil.rmtree(
+                    os.path.join(self.path, "versions", old),
+                    ignore_errors=True,
+                )
+        return version
+
+
+def token_streams(
+    movies: List[Dict[str, Any]],
+    hashes: List[str],
+    cache: TokenCache,
+    processes: int = PROCESSES,
+) -> Iterator[List[str]]:
+    streams = cache.get(hashes)
+    missing: Dict[str, str] = {}
+    for movie, key in zip(movies, hashes):
+        if key not in streams and key not in missing:
+            missing[key] = movie_text(movie)
+    log.info(
+        "Tokenizing %i texts, %i taken from cache.",
+        len(missing),
+        len(streams),
+    )
+
+    # Tokenized texts arrive in the order of their first occurrence
+    tokenized = zip(missing, tokenize_many(list(missing.values()), processes))
+    for key in hashes:
+        if key not in streams:
+            for new_key, tokens in tokenized:
+                streams[new_key] = tokens
+                if new_key == key:
+                    break
+        yield streams[key]
+
+    cache.put({key: streams[key] for key in missing})
+
+
+def changes(
+    previous: SimilarityModel,
+    slugs: List[str],
+    text_hashes: List[str],
+    feature_hashes: List[str],
+) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    # Movies whose text changed need new vectors, and those whose text or
+    # labels changed need new neighbours.
+    positions = {slug: i for i, slug in enumerate(previous.slugs)}
+    text_changed = np.array(
+        [
+            slug not in positions
+            or previous.text_hashes[positions[slug]] != text_hash
+            for slug, text_hash in zip(slugs, text_hashes)
+        ],
+        dtype=bool,
+    )
+    changed = text_changed | np.array(
+        [
+            slug not in positions
+            or previous.feature_hashes[positions[slug]] != feature_hash
+            for slug, feature_hash in zip(slugs, feature_hashes)
+        ],
+        dtype=bool,
+    )
+    removed = sorted(set(previous.slugs) - set(slugs))
+    return text_changed, changed, removed
+
+
+def run_mode(
+    previous: SimilarityModel,
+    incremental: bool,
+    text_changed: np.ndarray,
+    changed: np.ndarray,
+    removed: List[str],
+) -> Tuple[bool, bool]:
+    # Whether the run stays incremental and whether it reuses the stored
+    # models instead of fitting new ones
+    limit = MAX_CHANGED_RATIO * len(changed)
+    if incremental and changed.sum() + len(removed) > limit:
+        log.info("Too many changed movies, running a full update.")
+        incremental = False
+    elif incremental and previous.folded + text_changed.sum() > limit:
+        log.info(
+            "%i movies folded in since the last fit, running a full update.",
+            previous.folded + text_changed.sum(),
+        )
+        incremental = False
+    # A full run over the very texts the stored models were fitted on would
+    # fit the same models again
+    reuse = incremental or not (
+        text_changed.any() or removed or previous.folded
+    )
+    return incremental, reuse
+
+
+def fit(
+    token_streams: Iterable[List[str]],
+) -> Tuple[
+    gensim.corpora.Dictionary,
+    gensim.models.TfidfModel,
+    gensim.models.LsiModel,
+    np.ndarray,
+]:
+    stop_list = stopwords.words("english")
+
+    dictionary = gensim.corpora.Dictionary()
+    documents = []
+    for tokens in timed(token_streams, "tokenize"):
+        with stage("dictionary"):
+            dictionary.add_documents([tokens])
+            documents.append(tokens)
+    with stage("dictionary"):
+        stop_ids = [
+            dictionary.token2id[stopword]
+            for stopword in stop_list
+            if stopword in dictionary.token2id
+        ]
+        once_ids = [
+            tokenid
+            for tokenid, docfreq in dictionary.dfs.items()
+            if docfreq == 1
+        ]
+        dictionary.filter_tokens(stop_ids + once_ids)
+        dictionary.compactify()
+
+    with stage("tfidf"):
+        corpus = [dictionary.doc2bow(tokens) for tokens in documents]
+        tfidf = gensim.models.TfidfModel(corpus)
+        corpus_tfidf = tfidf[corpus]
+
+    with stage("lsi"):
+        lsi = gensim.models.LsiModel(
+            corpus_tfidf, id2word=dictionary, num_topics=utils.NUM_TOPICS
+        )
+
+    with stage("index"):
+        index = gensim.similarities.MatrixSimilarity(
+            lsi[corpus_tfidf], num_features=lsi.num_topics
+        )
+    return dictionary, tfidf, lsi, index.index
+
+
+def fold_in(
+    model: SimilarityModel, token_streams: Iterable[List[str]]
+) -> np.ndarray:
+    # Project documents into the existing LSI space without refitting it.
+    # Tokens the dictionary has never seen are ignored.
+    corpus = []
+    for tokens in timed(token_streams, "tokenize"):
+        with stage("dictionary"):
+            corpus.append(model.dictionary.doc2bow(tokens))
+    with stage("index"):
+        index = gensim.similarities.MatrixSimilarity(
+            model.lsi[model.tfidf[corpus]], num_features=model.lsi.num_topics
+        )
+    return index.index
+
+
+def reuse_vectors(  # pylint: disable=too-many-arguments
+    previous: SimilarityModel,
+    movies: List[Dict[str, Any]],
+    slugs: List[str],
+    text_hashes: List[str],
+    text_changed: np.ndarray,
+    cache: TokenCache,
+    processes: int = PROCESSES,
+) -> np.ndarray:
+    # Unchanged texts keep their stored vectors, the others are folded in
+    positions = {slug: i for i, slug in enumerate(previous.slugs)}
+    vectors = np.zeros(
+        (len(slugs), previous.vectors.shape[1]), dtype=np.float32
+    )
+    kept = np.flatnonzero(~text_changed)
+    vectors[kept] = previous.vectors[[positions[slugs[i]] for i in kept]]
+    folded = np.flatnonzero(text_changed)
+    if len(folded):
+        vectors[folded] = fold_in(
+            previous,
+            token_streams(
+                [movies[i]["movie"] for i in folded],
+                [text_hashes[i] for i in folded],
+                cache,
+                processes,
+            ),
+        )
+    return vectors
+
+
+def top_k(scores: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    # Partial selection of the k best columns of every row; only those k
+    # are sorted afterwards.
+    k = min(k, scores.shape[1])
+    ids = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    top = np.take_along_axis(scores, ids, axis=1)
+    order = np.argsort(-top, axis=1, kind="stable")
+    return (
+        np.take_along_axis(ids, order, axis=1).astype(np.int32),
+        np.take_along_axis(top, order, axis=1).astype(np.float32),
+    )
+
+
+def embeddings(
+    vectors: np.ndarray, features: utils.CorrelationFeatures
+) -> np.ndarray:
+    # Inner products over the weighted concatenation of LSI vectors and
+    # rank vectors approximate the blended score.
+    return np.hstack(
+        [
+            np.sqrt(TEXT_WEIGHT) * vectors,
+            np.sqrt(CORRELATION_WEIGHT) * features.dense(),
+        ]
+    ).astype(np.float32)
+
+
+class AnnIndex:
+    def __init__(self, embedding: np.ndarray, candidates: int):
+        self.embedding = embedding
+        self.candidates = min(candidates, len(embedding))
+        self.index = hnswlib.Index(space="ip", dim=embedding.shape[1])
+        self.index.init_index(
+            max_elements=len(embedding), ef_construction=200, M=16
+        )
+        self.index.add_items(embedding, np.arange(len(embedding)))
+        self.index.set_ef(max(2 * self.candidates, 100))
+
+    def query(self, rows: np.ndarray) -> np.ndarray:
+        labels, _ = self.index.knn_query(
+            self.embedding[rows], k=self.candidates
+        )
+        return labels.astype(np.int64)
+
+
+class BlendedScores:
+    # Blended text and correlation scores, computed one block of rows at a
+    # time so that no N x N matrix is ever held in memory, unless the
+    # correlations are kept in a memory-mapped scratch file.
+    def __init__(
+        self,
+        vectors: np.ndarray,
+        features: utils.CorrelationFeatures,
+        memory_budget_mb: int = MEMORY_BUDGET_MB,
+        scratch_dir: Union[str, None] = None,
+    ):
+        self.vectors = vectors
+        self.features = features
+        self.block_size = max(
+            1, memory_budget_mb * 2**20 // (ROW_BYTES * max(len(vectors), 1))
+        )
+
+        self.scratch_file = None
+        self.scratch = None
+        if scratch_dir:
+            os.makedirs(scratch_dir, exist_ok=True)
+            # pylint: disable=consider-using-with
+            self.scratch_file = tempfile.NamedTemporaryFile(
+                dir=scratch_dir, suffix=".corr"
+            )
+            self.scratch = np.memmap(
+                self.scratch_file,
+                dtype=np.float32,
+                mode="w+",
+                shape=(len(vectors), len(vectors)),
+            )
+
+        # Same scaling of every column to (-1, 1) as MinMaxScaler
+        with stage("correlation"):
+            lowest, highest = utils.calculate_correlations(
+                features, self.block_size, self.scratch
+            )
+        span = highest - lowest
+        span[span == 0] = 1
+        self.scale = 2 / span
+        self.offset = -1 - lowest * self.scale
+
+    def close(self) -> None:
+        if self.scratch_file is not None:
+            self.scratch = None
+            self.scratch_file.close()
+            self.scratch_file = None
+
+    def _correlations(self, rows: np.ndarray) -> np.ndarray:
+        if self.scratch is not None:
+            return np.array(self.scratch[rows])
+        return self.features.block(rows)
+
+    def rows(self, rows: np.ndarray) -> np.ndarray:
+        scores = self._correlations(rows)
+        scores *= CORRELATION_WEIGHT * self.scale
+        scores += CORRELATION_WEIGHT * self.offset
+        scores += TEXT_WEIGHT * self.vectors[rows].dot(self.vectors.T)
+        return scores
+
+    def columns(self, columns: np.ndarray) -> np.ndarray:
+        # The correlations are symmetric, so columns are transposed rows
+        scores = np.ascontiguousarray(self._correlations(columns).T)
+        scores *= CORRELATION_WEIGHT * self.scale[columns]
+        scores += CORRELATION_WEIGHT * self.offset[columns]
+        scores += TEXT_WEIGHT * self.vectors.dot(self.vectors[columns].T)
+        return scores
+
+    def pairs(self, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        scores = self.features.pairs(rows, columns)
+        scores *= CORRELATION_WEIGHT * self.scale[columns]
+        scores += CORRELATION_WEIGHT * self.offset[columns]
+        scores += TEXT_WEIGHT * np.einsum(
+            "bd,bcd->bc", self.vectors[rows], self.vectors[columns]
+        )
+        return scores
+
+    def neighbours(
+        self, rows: np.ndarray, ann: Union[AnnIndex, None] = None
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        ids = np.full((len(rows), NUM_NEIGHBOURS), -1, dtype=np.int32)
+        scores = np.full(
+            (len(rows), NUM_NEIGHBOURS), -np.inf, dtype=np.float32
+        )
+
+        for start in range(0, len(rows), self.block_size):
+            block = rows[start : start + self.block_size]
+            if ann is None:
+                candidates = None
+                with stage("blend"):
+                    sim_corr = self.rows(block)
+                sim_corr[np.arange(len(block)), block] = -np.inf
+            else:
+                # Exact blended scores, but only for approximate candidates
+                with stage("ann"):
+                    candidates = ann.query(block)
+                with stage("blend"):
+                    sim_corr = self.pairs(block, candidates)
+                sim_corr[candidates == block[:, None]] = -np.inf
+
+            with stage("top_k"):
+                block_ids, block_scores = top_k(sim_corr, NUM_NEIGHBOURS)
+            if candidates is not None:
+                block_ids = np.take_along_axis(
+                    candidates, block_ids, axis=1
+                ).astype(np.int32)
+            block_ids[np.isneginf(block_scores)] = -1
+            k = block_ids.shape[1]
+            ids[start : start + len(block), :k] = block_ids
+            scores[start : start + len(block), :k] = block_scores
+
+        return ids, scores
+
+
+def empty_neighbours(size: int) -> Tuple[np.ndarray, np.ndarray]:
+    return (
+        np.full((size, NUM_NEIGHBOURS), -1, dtype=np.int32),
+        np.full((size, NUM_NEIGHBOURS), -np.inf, dtype=np.float32),
+    )
+
+
+def carry_over(
+    previous: SimilarityModel, slugs: List[str], changed: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Remap stored neighbour lists onto current positions. A row is stale
+    # when its list points at a changed or removed movie.
+    positions = {slug: i for i, slug in enumerate(slugs)}
+    old_to_new = np.array(
+        [positions.get(slug, -1) for slug in previous.slugs], dtype=np.int32
+    )
+
+    neighbour_ids, neighbour_scores = empty_neighbours(len(slugs))
+    stale = np.ones(len(slugs), dtype=bool)
+
+    for position, slug in enumerate(previous.slugs):
+        i = positions.get(slug)
+        if i is None or changed[i]:
+            continue
+        old_ids = previous.neighbour_ids[position]
+        valid = old_ids >= 0
+        new_ids = old_to_new[old_ids[valid]]
+        neighbour_ids[i, : len(new_ids)] = new_ids
+        neighbour_scores[i, : len(new_ids)] = previous.neighbour_scores[
+            position
+        ][valid]
+        stale[i] = bool((new_ids < 0).any() or changed[new_ids].any())
+
+    return neighbour_ids, neighbour_scores, stale
+
+
+def affected_rows(
+    scores: BlendedScores,
+    changed: np.ndarray,
+    neighbour_ids: np.ndarray,
+    neighbour_scores: np.ndarray,
+    stale: np.ndarray,
+) -> np.ndarray:
+    # A row could get different neighbours if it changed itself, if its
+    # stored list is stale, or if a changed movie now beats its weakest
+    # stored neighbour.
+    full = (neighbour_ids >= 0).all(axis=1)
+    weakest = np.where(full, neighbour_scores.min(axis=1), -np.inf)
+
+    affected = changed | stale
+    changed_ids = np.flatnonzero(changed)
+    for start in range(0, len(changed_ids), scores.block_size):
+        block = changed_ids[start : start + scores.block_size]
+        block_scores = scores.columns(block)
+        block_scores[block, np.arange(len(block))] = -np.inf
+        affected |= block_scores.max(axis=1) > weakest
+    return affected
+
+
+def start_neighbours(
+    previous: Union[SimilarityModel, None],
+    slugs: List[str],
+    changed: np.ndarray,
+    scores: BlendedScores,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Neighbour lists to start from, and the rows whose lists have to be
+    # searched again. Without a previous model every row is searched.
+    if previous is None:
+        neighbour_ids, neighbour_scores = empty_neighbours(len(slugs))
+        return neighbour_ids, neighbour_scores, changed
+    neighbour_ids, neighbour_scores, stale = carry_over(
+        previous, slugs, changed
+    )
+    affected = affected_rows(
+        scores, changed, neighbour_ids, neighbour_scores, stale
+    )
+    return neighbour_ids, neighbour_scores, affected
+
+
+def ann_index(
+    vectors: np.ndarray, scores: BlendedScores, enabled: bool, candidates: int
+) -> Union[AnnIndex, None]:
+    if not enabled:
+        return None
+    if hnswlib is None:
+        log.warning("hnswlib is not installed, using exact neighbours.")
+        return None
+    return AnnIndex(embeddings(vectors, scores.features), candidates)
@@ -1,27 +1,42 @@
 import logging
-from typing import Dict
+from typing import Any, Dict, List, Union
 
-import gensim
+import numpy as np
+import redis.exceptions
 import requests.exceptions
-from celery import Task, chain, group
-from nltk.corpus import stopwords
-from nltk.stem.snowball import SnowballStemmer
-from nltk.tokenize import RegexpTokenizer
-from sklearn.preprocessing import MinMaxScaler
+from celery import Task, chain
 
 from asyncworker.celery import celery_app
-from asyncworker.tasks import utils
+from asyncworker.tasks import charts, queries, similarity, utils
 from asyncworker.tasks.clients import (
+    init_charts_dir,
     init_ibm_client,
     init_imdb_client,
+    init_model_store,
     init_mubi_client,
     init_neo4j_client,
     init_ororo_client,
+    init_redis_client,
     init_rotten_tomatoes_client,
+    init_similarity_settings,
 )
+from asyncworker.tasks.datasource import IMDB
+from asyncworker.tasks.ratelimit import RateLimitExceeded
 
 log = logging.getLogger(__name__)
 
+# Bumped after writes; the API keys its cached listings and facet index
+# on it. Writes within GENERATION_DELAY seconds share a single bump.
+GENERATION_KEY = "kotik:generation"
+GENERATION_PENDING_KEY = "kotik:generation:pending"
+GENERATION_DELAY = 30
+
+MEDIA_STATEMENTS = [
+    "create_movies",
+    "link_movie_genres",
+    "link_movie_countries",
+]
+
 
 # Task types
 class TaskWithRetry(Task):  # pylint: disable=abstract-method
@@ -31,6 +46,7 @@ class TaskWithRetry(Task):  # pylint: disable=abstract-method
         requests.exceptions.SSLError,
         requests.exceptions.HTTPError,
         requests.exceptions.Timeout,
+        RateLimitExceeded,
     )
     retry_backoff = True
 
@@ -40,6 +56,10 @@ class TaskWithRetry(Task):  # pylint: disable=abstract-method
     _ororo_client = None
     _rotten_tomatoes_client = None
     _mubi_client = None
+    _redis_client = None
+    _model_store = None
+    _similarity_settings = None
+    _charts_dir = None
 
     @property
     def neo4j_client(self):
@@ -77,252 +97,226 @@ class TaskWithRetry(Task):  # pylint: disable=abstract-method
             self._rotten_tomatoes_client = init_rotten_tomatoes_client()
         return self._rotten_tomatoes_client
 
+    @property
+    def redis_client(self):
+        if self._redis_client is None:
+            self._redis_client = init_redis_client()
+        return self._redis_client
 
-@celery_app.task(name="tasks.find_similarities", base=TaskWithRetry)
-def find_similarities() -> str:  # pylint: disable=too-many-locals
-    log.info("Finding similarities...")
-
-    tokenizer = RegexpTokenizer(r"\w+")
-    stemmer = SnowballStemmer("english")
-    stop_list = stopwords.words("english")
+    @property
+    def model_store(self):
+        if self._model_store is None:
+            self._model_store = init_model_store()
+        return self._model_store
 
-    dictionary = gensim.corpora.Dictionary()
+    @property
+    def similarity_settings(self):
+        if self._similarity_settings is None:
+            self._similarity_settings = init_similarity_settings()
+        return self._similarity_settings
 
-    # Clean up old similarities
-    with find_similarities.neo4j_client.session() as session:
-        query = "MATCH (:Movie)-[r:SIMILAR]-(:Movie) DETACH DELETE r"
-        utils.run_query(query, session)
-        query = "MATCH (m:Movie) RETURN m as movie"
-        movies = utils.run_query(query, session).data()
+    @property
+    def charts_dir(self):
+        if self._charts_dir is None:
+            self._charts_dir = init_charts_dir()
+        return self._charts_dir
 
-    for movie in movies:
-        text_list = []
 
-        for key in utils.TEXT_KEYS:
-            if movie["movie"][key] and isinstance(movie["movie"][key], str):
-                text_list.append(movie["movie"][key].lower())
+@celery_app.task(name="tasks.find_similarities", base=TaskWithRetry)
+def find_similarities(  # pylint: disable=too-many-locals, too-many-statements
+    incremental: bool = False,
+) -> str:
+    log.info("Finding similarities...")
+    similarity.timings.clear()
+
+    with similarity.stage("load"):
+        with find_similarities.neo4j_client.session() as session:
+            movies = queries.run("movies_with_labels", session)
+
+    slugs = [movie["movie"]["slug"] for movie in movies]
+    text_hashes = [similarity.text_hash(movie["movie"]) for movie in movies]
+    feature_hashes = [similarity.feature_hash(movie) for movie in movies]
+
+    settings = find_similarities.similarity_settings
+    store = find_similarities.model_store
+    previous = store.load()
+    if previous is None:
+        if incremental:
+            log.info("No stored similarity model, running a full update.")
+        incremental = reuse = False
+    else:
+        text_changed, changed, removed = similarity.changes(
+            previous, slugs, text_hashes, feature_hashes
+        )
+        incremental, reuse = similarity.run_mode(
+            previous, incremental, text_changed, changed, removed
+        )
 
-        text = ". ".join(text_list)
-        text_tokenized = tokenizer.tokenize(text)
-        text_tokenized_stemmed = [
-            stemmer.stem(word) for word in text_tokenized
-        ]
-        dictionary.add_documents([text_tokenized_stemmed])
-
-    stop_ids = [
-        dictionary.token2id[stopword]
-        for stopword in stop_list
-        if stopword in dictionary.token2id
-    ]
-    once_ids = [
-        tokenid for tokenid, docfreq in dictionary.dfs.items() if docfreq == 1
-    ]
-    dictionary.filter_tokens(stop_ids + once_ids)
-    dictionary.compactify()
+    if reuse:
+        dictionary, tfidf, lsi = (
+            previous.dictionary,
+            previous.tfidf,
+            previous.lsi,
+        )
+        vectors = similarity.reuse_vectors(
+            previous,
+            movies,
+            slugs,
+            text_hashes,
+            text_changed,
+            store.token_cache,
+            settings["processes"],
+        )
+        folded = previous.folded + int(text_changed.sum())
+    else:
+        dictionary, tfidf, lsi, vectors = similarity.fit(
+            similarity.token_streams(
+                [movie["movie"] for movie in movies],
+                text_hashes,
+                store.token_cache,
+                settings["processes"],
+            )
+        )
+        folded = 0
 
-    corpus = []
-    gensim_id = 0
-    for movie in movies:
-        text_list = []
-        for key in utils.TEXT_KEYS:
-            if movie["movie"][key] and isinstance(movie["movie"][key], str):
-                text_list.append(movie["movie"][key].lower())
+    if incremental:
+        log.info(
+            "Updating similarities for %i changed and %i removed movies.",
+            changed.sum(),
+            len(removed),
+        )
+    else:
+        changed = np.ones(len(slugs), dtype=bool)
+        removed = []
+
+    scores = similarity.BlendedScores(
+        vectors,
+        utils.correlation_features(movies),
+        settings["memory_budget_mb"],
+        settings["scratch_dir"],
+    )
 
-        text = ". ".join(text_list)
-        text_tokenized = tokenizer.tokenize(text)
-        text_tokenized_stemmed = [
-            stemmer.stem(word) for word in text_tokenized
-        ]
-        corpus.append(dictionary.doc2bow(text_tokenized_stemmed))
-        movie.update({"gensim_id": gensim_id})
-        gensim_id += 1
-
-    tfidf = gensim.models.TfidfModel(corpus)
-    corpus_tfidf = tfidf[corpus]
-
-    lsi = gensim.models.LsiModel(
-        corpus_tfidf, id2word=dictionary, num_topics=utils.NUM_TOPICS
+    neighbour_ids, neighbour_scores, affected = similarity.start_neighbours(
+        previous if incremental else None, slugs, changed, scores
     )
 
-    index = gensim.similarities.MatrixSimilarity(lsi[corpus_tfidf])
+    ann = similarity.ann_index(
+        vectors, scores, settings["ann"], settings["ann_candidates"]
+    )
 
-    corr = utils.calculate_correlations(find_similarities.neo4j_client)
-    corr_scaled = MinMaxScaler(feature_range=(-1, 1)).fit_transform(corr)
+    rows = np.flatnonzero(affected)
+    neighbour_ids[rows], neighbour_scores[rows] = scores.neighbours(rows, ann)
+    scores.close()
+
+    # Rows pointing at an affected movie lose their edge to it when the
+    # affected movie's edges are dropped, so they are written again too.
+    rewritten = affected | np.isin(
+        neighbour_ids, np.flatnonzero(affected)
+    ).any(axis=1)
+
+    edges = [
+        {"source": slugs[i], "target": slugs[j], "similarity": float(score)}
+        for i in np.flatnonzero(rewritten)
+        for j, score in zip(neighbour_ids[i], neighbour_scores[i])
+        if j >= 0 and score > similarity.SIMILARITY_THRESHOLD
+    ]
 
-    log.info("Updating neo4j with similarities.")
+    log.info("Updating neo4j with %i similarities.", len(edges))
+
+    with similarity.stage("write"):
+        with find_similarities.neo4j_client.session() as session:
+            queries.run("movie_slug_index", session)
+            if not incremental:
+                queries.run("delete_similarities", session)
+            else:
+                queries.run_batches(
+                    "delete_movie_similarities",
+                    [slugs[i] for i in np.flatnonzero(affected)] + removed,
+                    session,
+                    settings["write_batch_size"],
+                )
+            queries.run_batches(
+                "write_similarities",
+                edges,
+                session,
+                settings["write_batch_size"],
+            )
 
-    for i, similarities in enumerate(index):
-        log.debug(
-            "Updating neo4j with similarities for %s",
-            {movies[i]["movie"]["slug"]},
+    with similarity.stage("save"):
+        store.save(
+            similarity.SimilarityModel(
+                dictionary=dictionary,
+                tfidf=tfidf,
+                lsi=lsi,
+                slugs=slugs,
+                text_hashes=text_hashes,
+                feature_hashes=feature_hashes,
+                vectors=vectors,
+                neighbour_ids=neighbour_ids,
+                neighbour_scores=neighbour_scores,
+                folded=folded,
+            )
         )
-        assert i == movies[i]["gensim_id"]
-        correlations = corr_scaled[i]
-        sim_corr = 0.25 * similarities + 0.75 * correlations
-        neighbours = sorted(enumerate(sim_corr), key=lambda item: -item[1])[
-            1:11
-        ]
-        for j, similarity in neighbours:
-            if similarity > 0.25:
-                with find_similarities.neo4j_client.session() as session:
-                    query = """MATCH (m:Movie {slug: "%s"})
-                    MATCH (sm: Movie {slug: "%s"})
-                    MERGE (m)-[r:SIMILAR]-(sm)
-                    SET r.similarity = %f
-                    """ % (
-                        movies[i]["movie"]["slug"],
-                        movies[j]["movie"]["slug"],
-                        similarity,
-                    )
-                    utils.run_query(query, session)
+    log.info(
+        "Similarity stages: %s.",
+        ", ".join(
+            f"{name} {seconds:.2f}s"
+            for name, seconds in similarity.timings.items()
+        ),
+    )
+    if not incremental or rewritten.any() or removed:
+        data_changed(find_similarities)
     return "Similarities calculated."
 
 
-@celery_app.task(name="tasks.add_media", base=TaskWithRetry)
-def add_media(  # pylint: disable=too-many-branches, too-many-statements
-    item: Dict[str, str], media_type: str, source: str
-) -> str:
-    item_clean = {
-        key: utils.cypher_escape(value) for key, value in item.items()
-    }
+def data_changed(task: TaskWithRetry) -> None:
+    # The first write after a bump schedules the next one, so an ingest run
+    # of thousands of tasks reloads the API's listings a few times instead
+    # of once per task. The pending flag expires in case the bump is lost.
+    try:
+        if task.redis_client.set(
+            GENERATION_PENDING_KEY, 1, nx=True, ex=GENERATION_DELAY * 10
+        ):
+            bump_generation.apply_async(countdown=GENERATION_DELAY)
+    except redis.exceptions.RedisError as err:
+        log.warning("Cannot schedule a data generation bump: %s.", repr(err))
+
+
+@celery_app.task(
+    name="tasks.bump_generation",
+    base=TaskWithRetry,
+    autoretry_for=(redis.exceptions.ConnectionError,),
+)
+def bump_generation() -> str:
+    # The flag is cleared first, so a write landing after it schedules
+    # another bump rather than being missed
+    bump_generation.redis_client.delete(GENERATION_PENDING_KEY)
+    bump_generation.redis_client.incr(GENERATION_KEY)
+    return "Generation bumped"
 
-    with add_media.neo4j_client.session() as session:
-        if source == "ororo":
-            imdb_id = f'tt{item["imdb_id"]}'
-            slug = item_clean["slug"]
-        elif source == "mubi":
-            try:
-                imdb_id = add_media.imdb_client.get_id(
-                    item_clean["title"], item_clean["year"]
-                )
-                slug = item_clean["canonical_url"].split("/")[-1]
-            except KeyError:
-                log.warning("Could not find imdb id for '%s'.", item["title"])
-                return "No data added"
-        if not imdb_id:
-            return "No data added"
 
-        if item_clean["year"]:
-            try:
-                year = int(item_clean["year"])
-            except (ValueError, TypeError):
-                try:
-                    year = int(item_clean["year"].split("-")[0].strip())
-                except ValueError:
-                    year = -1
-        else:
-            year = -1
+@celery_app.task(name="tasks.add_media", base=TaskWithRetry)
+def add_media(item: Dict[str, Any], media_type: str, source: str) -> str:
+    row = media_row(item, media_type, source, add_media.imdb_client)
+    if not row:
+        return "No data added"
+    imdb_id = row["imdb_id"]
 
-        log.debug("Processing %s...", imdb_id)
+    log.debug("Processing %s...", imdb_id)
 
+    with add_media.neo4j_client.session() as session:
         # Find whether the movie is already in Neo4j
-        query = """MATCH (m: Movie {imdb_id: "%s", slug: "%s"})
-                    RETURN m.imdb_data, m.rotten_tomatoes_data, m.ibm_data;
-                    """ % (
-            imdb_id,
-            slug,
-        )
-        media = utils.run_query(query, session).data()
+        media = queries.run("existing_movies", session, rows=[row])
         if media:
-            if not media[0]["m.imdb_data"]:
+            if not media[0]["imdb_data"]:
                 add_imdb_data.apply_async(kwargs={"imdb_id": imdb_id})
-            # if not media[0]["m.rotten_tomatoes_data"]:
-            #     add_rotten_tomatoes_data.apply_async(
-            #         kwargs={"imdb_id": imdb_id}
-            #     )
-            # if not media[0]["m.ibm_data"]:
-            #     add_ibm_data.apply_async(kwargs={"imdb_id": imdb_id})
             log.info("Skipping %s, already in Neo4j", imdb_id)
             return "Skipping"
 
         # Add the movie to Neo4j
-        queries = []
-        if source == "ororo":
-            if not item_clean["imdb_rating"]:
-                item_clean["imdb_rating"] = "-1"
-            if not item_clean["length"]:
-                item_clean["length"] = "-1"
-
-            query = """MERGE (m: Movie {name: "%s",
-                                   source: "ororo",
-                                   slug: "%s",
-                                   type: "%s",
-                                   year: %i,
-                                   imdb_rating: %f,
-                                   imdb_id: "%s",
-                                   description: "%s",
-                                   length: %i,
-                                   link: "%s",
-                                   poster: "%s",
-                                   imdb_data: false,
-                                   rotten_tomatoes_data: false,
-                                   ibm_data: false
-                                   });
-                                   """ % (
-                item_clean["name"],
-                slug,
-                media_type,
-                year,
-                float(item_clean["imdb_rating"]),
-                f'tt{item_clean["imdb_id"]}',
-                item_clean["desc"],
-                int(item_clean["length"]),
-                str(f'https://ororo.tv/en/{media_type}/{item_clean["slug"]}'),
-                item_clean["poster_thumb"],
-            )
-            queries.append(query)
-
-            for genre in set(item_clean["array_genres"]):
-                query = """MATCH (m: Movie {imdb_id: "%s"})
-                                       MERGE (g: Genre {name: "%s"})
-                                       WITH g, m
-                                       MERGE (g)-[:HAS_MOVIE]->(m);
-                                       """ % (
-                    f'tt{item_clean["imdb_id"]}',
-                    genre.lower().strip(),
-                )
-                queries.append(query)
-
-            for country in set(item_clean["array_countries"]):
-                query = """MATCH (m: Movie {imdb_id: "%s"})
-                                               MERGE (c: Country {name: "%s"})
-                                               WITH c, m
-                                               MERGE (c)-[:HAS_MOVIE]->(m);
-                                               """ % (
-                    f'tt{item_clean["imdb_id"]}',
-                    country.strip(),
-                )
-                queries.append(query)
-
-        elif source == "mubi":
-            query = """MERGE (m: Movie {
-                imdb_id: "%s",
-                name: "%s", 
-                slug: "%s",
-                year: %i, 
-                source: "mubi", 
-                mubi_popularity: "%s", 
-                still_average_colour: "%s",
-                link: "%s",
-                poster: "%s",
-                imdb_data: false,
-                rotten_tomatoes_data: false,
-                ibm_data: false
-                })
-            """ % (
-                imdb_id,
-                item_clean["title"],
-                slug,
-                year,
-                int(item_clean["popularity"]),
-                item_clean["still_average_colour"],
-                item_clean["canonical_url"],
-                item_clean["still_url"],
-            )
-            queries.append(query)
         log.debug("Uploading %s data to Neo4j.", imdb_id)
-        for query in queries:
-            utils.run_query(query, session)
+        for name in MEDIA_STATEMENTS:
+            queries.run(name, session, rows=[row])
 
     # Add extra information
     job = chain(
@@ -332,21 +326,135 @@ def add_media(  # pylint: disable=too-many-branches, too-many-statements
     )
     job.apply_async()
 
+    data_changed(add_media)
+    return "Media added"
+
+
+def media_row(
+    item: Dict[str, Any], media_type: str, source: str, imdb_client: IMDB
+) -> Union[Dict[str, Any], None]:
+    if source == "ororo":
+        imdb_id = f'tt{item["imdb_id"]}'
+        slug = item["slug"]
+    elif source == "mubi":
+        try:
+            imdb_id = imdb_client.get_id(item["title"], item["year"])
+            slug = item["canonical_url"].split("/")[-1]
+        except KeyError:
+            log.warning("Could not find imdb id for '%s'.", item["title"])
+            return None
+    if not imdb_id:
+        return None
+
+    flags = {
+        "imdb_data": False,
+        "rotten_tomatoes_data": False,
+        "ibm_data": False,
+    }
+    if source == "ororo":
+        return {
+            "imdb_id": imdb_id,
+            "slug": slug,
+            "properties": {
+                "name": item["name"],
+                "source": "ororo",
+                "slug": slug,
+                "type": media_type,
+                "year": utils.parse_year(item["year"]),
+                "imdb_rating": float(item["imdb_rating"] or -1),
+                "imdb_id": imdb_id,
+                "description": item["desc"],
+                "length": int(item["length"] or -1),
+                "link": f"https://ororo.tv/en/{media_type}/{slug}",
+                "poster": item["poster_thumb"],
+                **flags,
+            },
+            "genres": list(
+                {genre.lower().strip() for genre in item["array_genres"]}
+            ),
+            "countries": list(
+                {country.strip() for country in item["array_countries"]}
+            ),
+        }
+    return {
+        "imdb_id": imdb_id,
+        "slug": slug,
+        "properties": {
+            "imdb_id": imdb_id,
+            "name": item["title"],
+            "slug": slug,
+            "year": utils.parse_year(item["year"]),
+            "source": "mubi",
+            "mubi_popularity": str(int(item["popularity"])),
+            "still_average_colour": item["still_average_colour"],
+            "link": item["canonical_url"],
+            "poster": item["still_url"],
+            **flags,
+        },
+        "genres": [],
+        "countries": [],
+    }
+
+
+@celery_app.task(name="tasks.add_media_chunk", base=TaskWithRetry)
+def add_media_chunk(
+    items: List[Dict[str, Any]], media_type: str, source: str
+) -> str:
+    rows = {}
+    for item in items:
+        # A malformed item is skipped rather than failing the whole chunk
+        try:
+            row = media_row(
+                item, media_type, source, add_media_chunk.imdb_client
+            )
+        except (ValueError, TypeError, KeyError) as err:
+            log.warning(
+                "Skipping malformed %s item %s: %s.",
+                source,
+                item.get("slug") or item.get("title"),
+                repr(err),
+            )
+            continue
+        if row:
+            rows[row["imdb_id"]] = row
+
+    with add_media_chunk.neo4j_client.session() as session:
+        # Find which movies of the chunk are already in Neo4j
+        existing = queries.run(
+            "existing_movies", session, rows=list(rows.values())
+        )
+        for media in existing:
+            if not media["imdb_data"]:
+                add_imdb_data.apply_async(kwargs={"imdb_id": media["imdb_id"]})
+            del rows[media["imdb_id"]]
+        log.info(
+            "Skipping %i items, already in Neo4j; adding %i.",
+            len(existing),
+            len(rows),
+        )
+
+        new_rows = list(rows.values())
+        if new_rows:
+            for name in MEDIA_STATEMENTS:
+                queries.run_batches(name, new_rows, session, len(new_rows))
+
+    # Add extra information
+    for imdb_id in rows:
+        add_imdb_data.apply_async(kwargs={"imdb_id": imdb_id})
+
+    if new_rows:
+        data_changed(add_media_chunk)
     return "Media added"
 
 
 @celery_app.task(name="tasks.add_imdb_data", base=TaskWithRetry)
 def add_imdb_data(imdb_id: str) -> str:
     with add_imdb_data.neo4j_client.session() as session:
-        query = (
-            'MATCH (m: Movie {imdb_id: "%s"}) RETURN m.imdb_data;' % imdb_id
-        )
-        data_flag = utils.run_query(query, session).data()
+        data_flag = queries.run("imdb_flag", session, imdb_id=imdb_id)
         if data_flag[0]["m.imdb_data"]:
             log.debug("IMDB data already present for %s.", imdb_id)
             return "No data added"
 
-    queries = []
     try:
         log.debug("Getting IMDB data for %s.", imdb_id)
         imdb_data = next(add_imdb_data.imdb_client.get(params={"i": imdb_id}))
@@ -354,76 +462,53 @@ def add_imdb_data(imdb_id: str) -> str:
         log.warning("Cannot get IMDB info for %s: %s.", imdb_id, repr(err))
         raise
 
-    query = (
-        'MATCH (m: Movie {imdb_id: "%s"}) SET m.imdb_data = true;' % imdb_id
-    )
-    queries.append(query)
+    properties: Dict[str, Any] = {"imdb_data": True}
     if "Plot" in imdb_data.keys():
-        query = 'MATCH (m: Movie {imdb_id: "%s"}) SET m.plot = "%s";' % (
-            imdb_id,
-            utils.cypher_escape(imdb_data["Plot"]),
-        )
-        queries.append(query)
+        properties["plot"] = imdb_data["Plot"]
+    names = {}
     if "Genre" in imdb_data.keys():
-        for genre in set(imdb_data["Genre"].split(",")):
-            query = """MATCH (m: Movie {imdb_id: "%s"})
-                MERGE (g: Genre {name: "%s"})
-                WITH g, m
-                MERGE (g)-[:HAS_MOVIE]->(m);
-                """ % (
-                imdb_id,
-                genre.lower().strip(),
-            )
-            queries.append(query)
+        names["link_genres"] = {
+            genre.lower().strip() for genre in imdb_data["Genre"].split(",")
+        }
     if "Actors" in imdb_data.keys():
-        for actor in set(imdb_data["Actors"].split(",")):
-            if actor != "n/a":
-                query = """MATCH (m: Movie {imdb_id: "%s"})
-                    MERGE (p: Person {name: "%s"})
-                    WITH p, m
-                    MERGE (p)-[:ACTED_IN]->(m);
-                    """ % (
-                    imdb_id,
-                    actor.lower().strip(),
-                )
-                queries.append(query)
+        names["link_actors"] = {
+            actor.lower().strip()
+            for actor in imdb_data["Actors"].split(",")
+            if actor != "n/a"
+        }
     if "Director" in imdb_data.keys():
-        for director in set(imdb_data["Director"].split(",")):
-            if director != "n/a":
-                query = """MATCH (m: Movie {imdb_id: "%s"})
-                    MERGE (p: Person {name: "%s"})
-                    WITH p, m
-                    MERGE (p)-[:DIRECTED]->(m);
-                    """ % (
-                    imdb_id,
-                    director.lower().strip(),
-                )
-                queries.append(query)
+        names["link_directors"] = {
+            director.lower().strip()
+            for director in imdb_data["Director"].split(",")
+            if director != "n/a"
+        }
 
     with add_imdb_data.neo4j_client.session() as session:
-        for query in queries:
-            utils.run_query(query, session)
+        queries.run(
+            "set_movie_properties",
+            session,
+            imdb_id=imdb_id,
+            properties=properties,
+        )
+        for name, values in names.items():
+            queries.run(name, session, imdb_id=imdb_id, names=list(values))
 
+    data_changed(add_imdb_data)
     return "Data added"
 
 
 @celery_app.task(name="tasks.add_rotten_tomatoes_data", base=TaskWithRetry)
 def add_rotten_tomatoes_data(imdb_id: str) -> str:
     with add_rotten_tomatoes_data.neo4j_client.session() as session:
-        query = (
-            """MATCH (m: Movie {imdb_id: "%s"})
-        RETURN m.rotten_tomatoes_data, m.slug, m.name;
-        """
-            % imdb_id
+        data_flag = queries.run(
+            "rotten_tomatoes_flag", session, imdb_id=imdb_id
         )
-        data_flag = utils.run_query(query, session).data()
         if data_flag[0]["m.rotten_tomatoes_data"]:
             log.debug("Rotten Tomatoes data already present for %s.", imdb_id)
             return "No data added"
         slug = data_flag[0]["m.slug"].replace("-", "_").replace("the_", "")
         title = data_flag[0]["m.name"]
 
-    queries = []
     try:
         log.info("Getting Rotten Tomatoes data for %s.", imdb_id)
         rt_data = next(
@@ -437,54 +522,29 @@ def add_rotten_tomatoes_data(imdb_id: str) -> str:
         )
         raise
 
-    query = (
-        """MATCH (m: Movie {imdb_id: "%s"})
-            SET m.rotten_tomatoes_data = true;
-            """
-        % imdb_id
-    )
-    queries.append(query)
+    properties: Dict[str, Any] = {"rotten_tomatoes_data": True}
 
     if "ratingSummary" in rt_data.keys():
-        query = """MATCH (m: Movie {imdb_id: "%s"})
-                    SET m.consensus = "%s"
-                    """ % (
-            imdb_id,
-            utils.cypher_escape(rt_data["ratingSummary"]["consensus"]),
-        )
-        queries.append(query)
+        properties["consensus"] = rt_data["ratingSummary"]["consensus"]
 
     try:
         if rt_data["ratingSummary"]["topCritics"]["averageRating"] != -1:
-            query = """MATCH (m: Movie {imdb_id: "%s"})
-                        SET m.critics_rating = %f
-                        """ % (
-                imdb_id,
-                float(rt_data["ratingSummary"]["topCritics"]["averageRating"]),
+            properties["critics_rating"] = float(
+                rt_data["ratingSummary"]["topCritics"]["averageRating"]
             )
-            queries.append(query)
     except KeyError:
         pass
 
     if "ratings" in rt_data.keys():
-        query = """MATCH (m: Movie {imdb_id: "%s"})
-                SET m.critics_score = %f
-                SET m.audience_score = %f;
-                """ % (
-            imdb_id,
-            float(rt_data["ratings"]["critics_score"]),
-            float(rt_data["ratings"]["audience_score"]),
+        properties["critics_score"] = float(
+            rt_data["ratings"]["critics_score"]
+        )
+        properties["audience_score"] = float(
+            rt_data["ratings"]["audience_score"]
         )
-        queries.append(query)
 
     if "synopsis" in rt_data.keys():
-        query = """MATCH (m: Movie {imdb_id: "%s"})
-                SET m.synopsis = "%s";
-                """ % (
-            imdb_id,
-            utils.cypher_escape(rt_data["synopsis"]),
-        )
-        queries.append(query)
+        properties["synopsis"] = rt_data["synopsis"]
 
     if "reviews" in rt_data.keys():
         reviews_list = []
@@ -493,35 +553,24 @@ def add_rotten_tomatoes_data(imdb_id: str) -> str:
                 reviews_list.append(review["quote"])
             except KeyError:
                 pass
-        reviews = ". ".join(reviews_list)
-        query = """MATCH (m: Movie {imdb_id: "%s"})
-                    SET m.reviews = "%s";
-                    """ % (
-            imdb_id,
-            utils.cypher_escape(reviews),
-        )
-        queries.append(query)
+        properties["reviews"] = ". ".join(reviews_list)
 
-    with add_rotten_tomatoes_data.neo4_client.session() as session:
-        for query in queries:
-            utils.run_query(query, session)
+    with add_rotten_tomatoes_data.neo4j_client.session() as session:
+        queries.run(
+            "set_movie_properties",
+            session,
+            imdb_id=imdb_id,
+            properties=properties,
+        )
 
+    data_changed(add_rotten_tomatoes_data)
     return "Data added"
 
 
 @celery_app.task(name="tasks.add_ibm_data", base=TaskWithRetry)
-def add_ibm_data(  # pylint: disable=too-many-locals, too-many-branches
-    imdb_id: str,
-) -> str:
+def add_ibm_data(imdb_id: str) -> str:  # pylint: disable=too-many-locals
     with add_ibm_data.neo4j_client.session() as session:
-        query = (
-            """MATCH (m: Movie {imdb_id: "%s"})
-            RETURN m.ibm_data, m.plot, m.description,
-                   m.synopsis, m.reviews, m.consensus;
-            """
-            % imdb_id
-        )
-        data_flag = utils.run_query(query, session).data()
+        data_flag = queries.run("ibm_texts", session, imdb_id=imdb_id)
 
         if data_flag[0]["m.ibm_data"]:
             return "No data added"
@@ -534,103 +583,97 @@ def add_ibm_data(  # pylint: disable=too-many-locals, too-many-branches
     if not text:
         log.info("Movie %s does not have text, skipping.", imdb_id)
         return "No data added"
-    queries = []
     try:
         log.info("Getting IBM data for %s.", imdb_id)
-        ibm_data = next(
-            add_ibm_data.ibm_client.get(
-                path="/v1/analyze",
-                params={
-                    "version": "2019-07-12",
-                    "features": "emotion,categories",
-                    "text": text,
-                },
-            )
+        ibm_data = add_ibm_data.ibm_client.analyze(
+            text, features="emotion,categories", version="2019-07-12"
         )
-    except (requests.exceptions.RequestException, StopIteration) as err:
+    except requests.exceptions.RequestException as err:
         log.warning("Cannot get IBM info for %s: %s.", imdb_id, repr(err))
         raise
 
-    for cat in set(ibm_data["categories"]):
-        if cat["score"] > 0.75:
-            categories = cat["label"].split("/")
-            categories = [c.lower().strip() for c in categories if c]
-            if categories:
-                for i, category in enumerate(categories[1:]):
-                    if i == 0:
-                        query = (
-                            'MERGE (c:Category {name: "%s"})'
-                            % utils.cypher_escape(category.lower().strip())
-                        )
-                    else:
-                        query = """MATCH (n:Category {name: "%s"})
-                        MERGE (c:Category {name: "%s"})
-                        WITH c, n
-                        MERGE (n)-[:HAS_SUBCATEGORY]->(c)
-                        """ % (
-                            utils.cypher_escape(categories[i - 1]),
-                            utils.cypher_escape(category),
-                        )
-                    queries.append(query)
-                for category in categories[1:]:
-                    query = """
-                        MATCH (m:Movie {imdb_id: "%s"})
-                        SET m.ibm_data = true
-                        MERGE (c:Category {name: "%s"})
-                        WITH m, c
-                        MERGE (c)-[r:HAS_MOVIE]->(m)
-                        SET r.score = %f;
-                        """ % (
-                        imdb_id,
-                        utils.cypher_escape(category),
-                        cat["score"],
-                    )
-                    queries.append(query)
-    for emotion, score in ibm_data["emotion"]["document"]["emotion"].items():
-        query = """MATCH (m: Movie {imdb_id: "%s"})
-            SET m.ibm_data = true
-            SET m.%s = %f
-            """ % (
-            imdb_id,
-            emotion.lower().strip(),
-            score,
-        )
-        queries.append(query)
-
+    written = False
     with add_ibm_data.neo4j_client.session() as session:
-        for query in queries:
-            utils.run_query(query, session)
+        for cat in ibm_data["categories"]:
+            if cat["score"] > 0.75:
+                categories = cat["label"].split("/")
+                categories = [c.lower().strip() for c in categories if c]
+                if len(categories) > 1:
+                    queries.run("merge_category", session, name=categories[1])
+                    queries.run(
+                        "link_subcategories",
+                        session,
+                        pairs=[
+                            {"parent": categories[i - 1], "child": category}
+                            for i, category in enumerate(categories[1:])
+                            if i > 0
+                        ],
+                    )
+                    queries.run(
+                        "link_categories",
+                        session,
+                        imdb_id=imdb_id,
+                        names=categories[1:],
+                        score=cat["score"],
+                    )
+                    written = True
+        emotions = ibm_data["emotion"]["document"]["emotion"]
+        if emotions:
+            properties = {
+                emotion.lower().strip(): score
+                for emotion, score in emotions.items()
+            }
+            queries.run(
+                "set_movie_properties",
+                session,
+                imdb_id=imdb_id,
+                properties={"ibm_data": True, **properties},
+            )
+            written = True
 
+    render_emotion_charts.apply_async(kwargs={"imdb_ids": [imdb_id]})
+    if written:
+        data_changed(add_ibm_data)
     return "Data added"
 
 
+@celery_app.task(name="tasks.render_emotion_charts", base=TaskWithRetry)
+def render_emotion_charts(imdb_ids: Union[List[str], None] = None) -> str:
+    with render_emotion_charts.neo4j_client.session() as session:
+        media = queries.run("emotions", session, imdb_ids=imdb_ids)
+
+    # Existing charts are kept, so a full run only renders the missing ones
+    for item in media:
+        charts.emotions_chart(item, render_emotion_charts.charts_dir)
+
+    return "Charts rendered"
+
+
 @celery_app.task(name="tasks.update_database", base=TaskWithRetry)
-def update_database() -> str:
+def update_database(
+    bulk: bool = True, chunk_size: int = utils.INGEST_CHUNK_SIZE
+) -> str:
     log.info("Updating movie database...")
 
-    constraints = [
-        "CREATE CONSTRAINT ON (m:Movie) ASSERT m.imdb_id IS UNIQUE",
-        "CREATE CONSTRAINT ON (g:Genre) ASSERT g.name IS UNIQUE",
-        "CREATE CONSTRAINT ON (c:Category) ASSERT c.name IS UNIQUE",
-        "CREATE CONSTRAINT ON (p:Person) ASSERT p.name IS UNIQUE",
-    ]
-    for constraint in constraints:
+    for name in queries.SCHEMA:
         with update_database.neo4j_client.session() as session:
-            utils.run_query(constraint, session)
+            queries.run(name, session)
 
     # Get movies and series from Ororo
-    ororo_movies = update_database.ororo_client.get(path="movies")
-    job = group(
-        (add_media.si(item, "movies", "ororo") for item in ororo_movies)
-    )
-    job.apply_async()
-    ororo_shows = update_database.ororo_client.get(path="shows")
-    job = group((add_media.si(item, "shows", "ororo") for item in ororo_shows))
-    job.apply_async()
+    for media_type in ("movies", "shows"):
+        # Items are streamed from the response, so every chunk is sent
+        # while the rest of the catalog is still downloading.
+        items = update_database.ororo_client.get(path=media_type)
+        if bulk:
+            for chunk in utils.chunked(items, chunk_size):
+                add_media_chunk.si(chunk, media_type, "ororo").apply_async()
+        else:
+            for item in items:
+                add_media.si(item, media_type, "ororo").apply_async()
 
     # # Get movies from Mubi
     # mubi_movies = update_database.mubi_client.get(path="films")
-    # job = group((add_media.si(item, "movies", "mubi") for item in mubi_movies))
-    # job.apply_async()
+    # for chunk in utils.chunked(mubi_movies, chunk_size):
+    #     add_media_chunk.si(chunk, "movies", "mubi").apply_async()
 
     return "Started update"
@@ -1,87 +1,246 @@
 import logging
-import time
-from typing import Union
+from typing import Any, Dict, Iterable, Iterator, List, Tuple, Union
 
-import neo4j.exceptions
+import numpy as np
 import pandas as pd
-from neo4j import GraphDatabase
+from scipy import sparse
+from sklearn.preprocessing import MultiLabelBinarizer
 
 log = logging.getLogger(__name__)
 
 
 NUM_TOPICS = 500
+INGEST_CHUNK_SIZE = 500
 TEXT_KEYS = ["plot", "description"]
+FEATURE_KEYS = [
+    "sadness",
+    "anger",
+    "joy",
+    "fear",
+    "disgust",
+    "imdb_rating",
+    "critics_score",
+    "audience_score",
+    "critics_rating",
+]
+
+
+def chunked(items: Iterable[Any], size: int) -> Iterator[List[Any]]:
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def parse_year(year: Any) -> int:
+    if not year:
+        return -1
+    try:
+        return int(year)
+    except (ValueError, TypeError):
+        try:
+            return int(year.split("-")[0].strip())
+        except ValueError:
+            return -1
+
+
+class CorrelationFeatures:
+    # Spearman correlation between two movies is the dot product of their
+    # centred, normalised rank vectors. Label columns only ever hold the
+    # rank of a 0 or of a 1, so they are kept as a sparse multi-hot matrix
+    # plus the two per-movie values instead of a dense rank matrix.
+    def __init__(
+        self,
+        numeric: np.ndarray,
+        labels: sparse.csr_matrix,
+        zero: np.ndarray,
+        one: np.ndarray,
+    ):
+        self.numeric = numeric
+        self.labels = labels
+        self.zero = zero
+        self.one = one
+        self.counts = np.asarray(labels.sum(axis=1), dtype=np.float32).ravel()
+
+    def __len__(self) -> int:
+        return self.numeric.shape[0]
+
+    def block(self, rows: np.ndarray) -> np.ndarray:
+        zero, one, counts = self.zero, self.one, self.counts
+        num_labels = self.labels.shape[1]
+
+        corr = self.numeric[rows].dot(self.numeric.T)
+        corr += np.outer(zero[rows], zero * (num_labels - counts))
+        corr -= np.outer(zero[rows] * counts[rows], zero)
+        corr += np.outer(zero[rows], one * counts)
+        corr += np.outer(one[rows] * counts[rows], zero)
+        shared = self.labels[rows].dot(self.labels.T).toarray()
+        corr += (
+            (zero[rows] - one[rows])[:, None]
+            * shared.astype(np.float32)
+            * (zero - one)[None, :]
+        )
+        return corr
 
+    def pairs(self, rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+        # Correlations of every row with its own list of columns
+        zero, one, counts = self.zero, self.one, self.counts
+        num_labels = self.labels.shape[1]
+        flat = columns.ravel()
 
-def run_query(query: str, session: neo4j.Session) -> Union[neo4j.Result, None]:
-    retries = 0
-    while retries <= 3:
-        try:
-            return session.run(query)
-        except neo4j.exceptions.TransientError:
-            wait = retries * 5
-            time.sleep(wait)
-            retries += 1
-        except neo4j.exceptions.ConstraintError:
-            log.warning("Item already exists: %s.", str(query))
-            return None
-    raise RuntimeError
-
-
-def cypher_escape(string: str) -> str:
-    try:
-        return string.replace('"', "'")
-    except AttributeError:
-        return string
+        corr = np.einsum(
+            "bf,bcf->bc", self.numeric[rows], self.numeric[columns]
+        )
+        corr += (
+            zero[rows][:, None]
+            * zero[columns]
+            * (num_labels - counts[rows][:, None] - counts[columns])
+        )
+        corr += zero[rows][:, None] * one[columns] * counts[columns]
+        corr += (one[rows] * counts[rows])[:, None] * zero[columns]
+        shared = np.asarray(
+            self.labels[np.repeat(rows, columns.shape[1])]
+            .multiply(self.labels[flat])
+            .sum(axis=1),
+            dtype=np.float32,
+        ).reshape(columns.shape)
+        corr += (
+            (zero[rows] - one[rows])[:, None]
+            * shared
+            * (zero[columns] - one[columns])
+        )
+        return corr
+
+    def dense(self) -> np.ndarray:
+        labels = self.labels.toarray().astype(np.float32)
+        return np.hstack(
+            [
+                self.numeric,
+                self.zero[:, None] + (self.one - self.zero)[:, None] * labels,
+            ]
+        )
 
 
-def calculate_correlations(neo4j_client: GraphDatabase) -> pd.DataFrame:
-    log.info("Calculating correlations...")
+def numeric_features(movies: List[Dict[str, Any]]) -> np.ndarray:
+    numeric = pd.DataFrame(
+        [
+            [movie["movie"].get(key) for key in FEATURE_KEYS]
+            for movie in movies
+        ],
+        columns=FEATURE_KEYS,
+    ).apply(pd.to_numeric, errors="coerce")
+    return numeric.loc[:, numeric.notna().any()].to_numpy(np.float32)
+
+
+def label_features(movies: List[Dict[str, Any]]) -> sparse.csr_matrix:
+    return sparse.hstack(
+        [
+            MultiLabelBinarizer(sparse_output=True).fit_transform(
+                [movie[key] for movie in movies]
+            )
+            for key in ("genres", "categories")
+        ],
+        format="csr",
+        dtype=np.float32,
+    )
 
-    with neo4j_client.session() as session:
-        query = """MATCH (m:Movie)
-        OPTIONAL MATCH (g:Genre)-[:HAS_MOVIE]->(m)
-        OPTIONAL MATCH (c:Category)-[:HAS_MOVIE]->(m)
-        WITH m, collect(distinct g.name) as genres, collect(distinct c.name) as categories
-        RETURN m.slug as slug,
-               m.imdb_id as id,
-               m.sadness as sadness,
-               m.anger as anger,
-               m.joy as joy,
-               m.fear as fear, 
-               m.disgust as disgust, 
-               m.imdb_rating as rating, 
-               m.critics_score as critics_score,
-               m.audience_score as audience_score,
-               m.critics_rating as critics_rating,
-               genres,
-               categories;
-        """
-        movies = run_query(query, session).data()
-
-    dataframe = pd.DataFrame(movies)
-
-    genres = set(gen for gen in dataframe["genres"].values for gen in gen)
-    categories = set(
-        cat for cat in dataframe["categories"].values for cat in cat
+
+def value_rank(
+    numeric: np.ndarray,
+    value: float,
+    below: Union[np.ndarray, float],
+    ties: np.ndarray,
+) -> np.ndarray:
+    # Average rank of a label value within each movie's row, given how many
+    # label columns hold a smaller value and how many hold the same one
+    return (
+        (numeric < value).sum(axis=1)
+        + below
+        + ((numeric == value).sum(axis=1) + ties + 1) / 2
     )
 
-    genre = None
-    for genre in genres:
-        dataframe[genre] = dataframe.apply(
-            lambda x: 1 if genre in x["genres"] else 0, axis=1
-        )
-    category = None
-    for category in categories:
-        dataframe[category] = dataframe.apply(
-            lambda x: 1 if category in x["categories"] else 0, axis=1
-        )
 
-    dataframe.drop("genres", axis=1, inplace=True)
-    dataframe.drop("categories", axis=1, inplace=True)
+def centred_ranks(
+    numeric: np.ndarray, counts: np.ndarray, num_labels: np.float32
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # Average ranks within each movie's row: a value ranks after every
+    # smaller value and in the middle of the values equal to it. Label
+    # columns contribute (num_labels - counts) zeros and counts ones.
+    zeros = num_labels - counts
+    valid = ~np.isnan(numeric)
+    values = numeric[:, :, None]
+    others = values.transpose(0, 2, 1)
+    less = (
+        (others < values).sum(axis=2)
+        + (values[:, :, 0] > 0) * zeros[:, None]
+        + (values[:, :, 0] > 1) * counts[:, None]
+    )
+    equal = (
+        (others == values).sum(axis=2)
+        + (values[:, :, 0] == 0) * zeros[:, None]
+        + (values[:, :, 0] == 1) * counts[:, None]
+    )
+    numeric_ranks = less + (equal + 1) / 2
+    zero_rank = value_rank(numeric, 0, 0, zeros)
+    one_rank = value_rank(numeric, 1, zeros, counts)
+
+    # Missing values get the mean rank, so they do not contribute
+    mean_rank = (valid.sum(axis=1) + num_labels + 1) / 2
+    return (
+        np.where(valid, numeric_ranks - mean_rank[:, None], 0),
+        zero_rank - mean_rank,
+        one_rank - mean_rank,
+    )
+
+
+def correlation_features(movies: List[Dict[str, Any]]) -> CorrelationFeatures:
+    numeric = numeric_features(movies)
+    labels = label_features(movies)
+    counts = np.asarray(labels.sum(axis=1), dtype=np.float32).ravel()
+    num_labels = np.float32(labels.shape[1])
+    numeric_ranks, zero_rank, one_rank = centred_ranks(
+        numeric, counts, num_labels
+    )
+
+    norms = np.sqrt(
+        (numeric_ranks**2).sum(axis=1)
+        + (num_labels - counts) * zero_rank**2
+        + counts * one_rank**2
+    )
+    norms[norms == 0] = np.inf
+
+    return CorrelationFeatures(
+        numeric=(numeric_ranks / norms[:, None]).astype(np.float32),
+        labels=labels,
+        zero=(zero_rank / norms).astype(np.float32),
+        one=(one_rank / norms).astype(np.float32),
+    )
+
+
+def calculate_correlations(
+    features: CorrelationFeatures,
+    block_size: int,
+    scratch: Union[np.ndarray, None] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    # The correlation matrix is symmetric, so the per-column minimum and
+    # maximum needed for scaling are the per-row ones. Blocks are written
+    # to the scratch matrix, when given, so they are not computed twice.
+    log.info("Calculating correlations...")
 
-    corr = dataframe.select_dtypes(["number"]).T.corr("spearman")  # 'kendall'
+    lowest = np.empty(len(features), dtype=np.float32)
+    highest = np.empty(len(features), dtype=np.float32)
+    for start in range(0, len(features), block_size):
+        rows = np.arange(start, min(start + block_size, len(features)))
+        corr = features.block(rows)
+        lowest[rows] = corr.min(axis=1)
+        highest[rows] = corr.max(axis=1)
+        if scratch is not None:
+            scratch[rows] = corr
 
     log.info("Correlations calculated.")
 
-    return corr
+    return lowest, highest
@@ -0,0 +1,329 @@
+"""Benchmarks of find_similarities on synthetic catalogs.
+
+Run from the asyncworker directory:
+
+    python -m benchmarks.similarity                 # compare to baselines
+    python -m benchmarks.similarity --save          # record new baselines
+    python -m benchmarks.similarity --sizes 1000    # a single corpus size
+
+Every corpus size runs in its own process, so the reported peak memory
+belongs to that size alone.
+"""
+
+import argparse
+import copy
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List
+
+import numpy as np
+
+SIZES = [1000, 10000, 50000]
+BASELINES = os.path.join(os.path.dirname(__file__), "baselines.json")
+TOLERANCE = 0.25
+# Share of the catalog whose plot changes before the incremental run
+CHANGED_RATIO = 0.01
+
+GENRES = [
+    "action",
+    "adventure",
+    "animation",
+    "biography",
+    "comedy",
+    "crime",
+    "documentary",
+    "drama",
+    "family",
+    "fantasy",
+    "history",
+    "horror",
+    "music",
+    "musical",
+    "mystery",
+    "romance",
+    "sci-fi",
+    "sport",
+    "thriller",
+    "war",
+    "western",
+]
+SYLLABLES = [
+    consonant + vowel
+    for consonant in "bcdfghklmnprstvwz"
+    for vowel in ["a", "e", "i", "o", "u", "ai", "ou"]
+]
+
+
+def vocabulary(rng: np.random.Generator, size: int) -> np.ndarray:
+    lengths = rng.integers(1, 4, size=size)
+    return np.array(
+        ["".join(rng.choice(SYLLABLES, size=length)) for length in lengths]
+    )
+
+
+def sentence(
+    rng: np.random.Generator, words: np.ndarray, cdf: np.ndarray, size: int
+) -> str:
+    # Inverse transform sampling, rng.choice rebuilds the cdf on every call
+    indices = np.searchsorted(cdf, rng.random(size), side="right")
+    return " ".join(words[indices]) + "."
+
+
+def make_corpus(size: int, seed: int = 0) -> List[Dict[str, Any]]:
+    # Word frequencies follow Zipf's law like natural language, genres are
+    # skewed towards drama and comedy, and every movie sits in a few of a
+    # few hundred categories, as Watson returns them.
+    rng = np.random.default_rng(seed)
+    words = vocabulary(rng, 20000)
+    weights = 1 / np.arange(1, len(words) + 1) ** 1.1
+    cdf = np.cumsum(weights / weights.sum())
+    genre_weights = 1 / np.arange(1, len(GENRES) + 1)
+    genre_weights /= genre_weights.sum()
+    categories = [
+        " ".join(name) for name in zip(vocabulary(rng, 300), words[:300])
+    ]
+
+    movies = []
+    for i in range(size):
+        critics = rng.random() < 0.7
+        movie = {
+            "slug": f"movie-{i}",
+            "imdb_id": f"tt{i:07d}",
+            "name": sentence(rng, words, cdf, 3),
+            "plot": " ".join(
+                sentence(rng, words, cdf, rng.integers(8, 25))
+                for _ in range(rng.integers(3, 10))
+            ),
+            "description": sentence(rng, words, cdf, rng.integers(15, 40)),
+            "sadness": float(rng.beta(2, 5)),
+            "anger": float(rng.beta(2, 6)),
+            "joy": float(rng.beta(2, 3)),
+            "fear": float(rng.beta(2, 5)),
+            "disgust": float(rng.beta(1, 6)),
+            "imdb_rating": (
+                float(np.clip(rng.normal(6.4, 1.1), 1, 9.8))
+                if rng.random() < 0.95
+                else -1.0
+            ),
+            "critics_score": float(rng.integers(0, 101)) if critics else None,
+            "audience_score": float(rng.integers(0, 101)) if critics else None,
+            "critics_rating": (
+                float(np.round(rng.uniform(2, 9.5), 1)) if critics else None
+            ),
+        }
+        movies.append(
+            {
+                "movie": movie,
+                "genres": sorted(
+                    set(
+                        rng.choice(
+                            GENRES, size=rng.integers(1, 4), p=genre_weights
+                        )
+                    )
+                ),
+                "categories": sorted(
+                    set(rng.choice(categories, size=rng.integers(0, 6)))
+                ),
+            }
+        )
+    return movies
+
+
+class Result:
+    def __init__(self, rows: List[Dict[str, Any]]):
+        self.rows = rows
+
+    def data(self) -> List[Dict[str, Any]]:
+        return self.rows
+
+    def consume(self) -> None:
+        return None
+
+
+class Session:
+    # Answers the statements find_similarities runs from an in-memory
+    # catalog and counts the rows it writes.
+    def __init__(self, driver: "Driver"):
+        self.driver = driver
+
+    def __enter__(self) -> "Session":
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        return None
+
+    def run(self, query: str, parameters: Any = None, **kwargs: Any) -> Result:
+        # pylint: disable=import-outside-toplevel
+        from asyncworker.tasks import queries
+
+        if query == queries.STATEMENTS["movies_with_labels"]:
+            return Result(copy.deepcopy(self.driver.movies))
+        rows = (parameters or kwargs).get("rows")
+        if rows is not None:
+            self.driver.written += len(rows)
+        return Result([])
+
+    def execute_write(self, function: Any, *args: Any) -> Any:
+        return function(self, *args)
+
+
+class Driver:
+    def __init__(self, movies: List[Dict[str, Any]]):
+        self.movies = movies
+        self.written = 0
+
+    def session(self, **_kwargs: Any) -> Session:
+        return Session(self)
+
+
+class Redis:
+    def set(self, _key: str, _value: Any, **_kwargs: Any) -> bool:
+        # A generation bump is always pending, so none is scheduled
+        return False
+
+
+def run_size(size: int) -> Dict[str, Any]:  # pylint: disable=too-many-locals
+    # The worker reads config.json from its working directory on import
+    workdir = tempfile.mkdtemp(prefix="kotik-benchmark-")
+    with open(
+        os.path.join(workdir, "config.json"), "w", encoding="utf-8"
+    ) as handle:
+        json.dump({}, handle)
+    os.chdir(workdir)
+
+    # pylint: disable=import-outside-toplevel
+    from asyncworker.tasks import similarity, tasks
+    from asyncworker.tasks.clients import init_similarity_settings
+
+    start = time.perf_counter()
+    movies = make_corpus(size)
+    corpus_time = time.perf_counter() - start
+
+    # pylint: disable=protected-access
+    driver = Driver(movies)
+    task = tasks.find_similarities
+    task._neo4j_client = driver
+    task._redis_client = Redis()
+    task._model_store = similarity.ModelStore(os.path.join(workdir, "models"))
+    task._similarity_settings = init_similarity_settings()
+
+    runs = {}
+    rng = np.random.default_rng(1)
+    for name, incremental in (("full", False), ("incremental", True)):
+        if incremental:
+            changed = rng.choice(
+                size, size=max(1, int(size * CHANGED_RATIO)), replace=False
+            )
+            for i in changed:
+                driver.movies[i]["movie"]["plot"] += " A sequel follows."
+        driver.written = 0
+        start = time.perf_counter()
+        task(incremental=incremental)
+        runs[name] = {
+            "wall": time.perf_counter() - start,
+            "stages": dict(similarity.timings),
+            "written": driver.written,
+        }
+
+    return {
+        "size": size,
+        "corpus": corpus_time,
+        "peak_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "runs": runs,
+    }
+
+
+def measure(size: int) -> Dict[str, Any]:
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.similarity", "--child", str(size)],
+        check=True,
+        stdout=subprocess.PIPE,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    ).stdout
+    return json.loads(output.decode().splitlines()[-1])
+
+
+def compare(
+    result: Dict[str, Any], baseline: Dict[str, Any], tolerance: float
+) -> List[str]:
+    metrics = [("peak_mb", result["peak_mb"], baseline["peak_mb"])]
+    for name, run in result["runs"].items():
+        reference = baseline["runs"][name]
+        metrics.append((f"{name} wall", run["wall"], reference["wall"]))
+        for stage, seconds in run["stages"].items():
+            metrics.append(
+                (
+                    f"{name} {stage}",
+                    seconds,
+                    reference["stages"].get(stage, 0.0),
+                )
+            )
+    # Stages that take a few milliseconds are too noisy to compare
+    return [
+        f"{metric}: {value:.3f} vs {reference:.3f}"
+        for metric, value, reference in metrics
+        if value > reference * (1 + tolerance) and value - reference > 0.05
+    ]
+
+
+def report(result: Dict[str, Any]) -> None:
+    print(
+        f'{result["size"]} movies: peak {result["peak_mb"]:.0f} MB, '
+        f'corpus generated in {result["corpus"]:.1f}s'
+    )
+    for name, run in result["runs"].items():
+        stages = ", ".join(
+            f"{stage} {seconds:.2f}s"
+            for stage, seconds in run["stages"].items()
+        )
+        print(
+            f'  {name}: {run["wall"]:.2f}s, '
+            f'{run["written"]} edges written ({stages})'
+        )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--baselines", default=BASELINES)
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--save", action="store_true")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run_size(args.child)))
+        return 0
+
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines, encoding="utf-8") as handle:
+            baselines = json.load(handle)
+
+    regressions = []
+    for size in args.sizes:
+        result = measure(size)
+        report(result)
+        baseline = baselines.get(str(size))
+        if args.save:
+            result["machine"] = f"{platform.machine()} {os.cpu_count()} cpus"
+            baselines[str(size)] = result
+        elif baseline is not None:
+            for regression in compare(result, baseline, args.tolerance):
+                print(f"  REGRESSION {regression}")
+                regressions.append(regression)
+
+    if args.save:
+        with open(args.baselines, "w", encoding="utf-8") as handle:
+            json.dump(baselines, handle, indent=2, sort_keys=True)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
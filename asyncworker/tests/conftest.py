@@ -0,0 +1,9 @@
+import os
+
+import asyncworker
+
+# Tests are collected as asyncworker.tests, so the worker's own package in
+# asyncworker/asyncworker is made importable under the same name.
+asyncworker.__path__.append(
+    os.path.join(os.path.dirname(os.path.dirname(__file__)), "asyncworker")
+)
@@ -0,0 +1,44 @@
+import json
+
+import pytest
+
+from asyncworker.tasks.jsonstream import stream_json
+
+DOCUMENTS = [
+    (
+        '[1, 2.5, -3e2, {"name": "Amélie", "year": 2001}, "日本", true, 10]',
+        None,
+    ),
+    ("[12345]", None),
+    ("[]", None),
+    ("-1.25e3", None),
+    ('{"page": 1, "movies": [{"title": "Léon"}, 7], "total": 12}', "movies"),
+    ('{"total": 12, "movies": [3.5, "Ça"]}', "movies"),
+    ('{"page": 1, "count": 12345}', "count"),
+    ('{"page": 1, "results": [1, 2]}', "movies"),
+    ('{"page": 1, "results": [1, 2]}', None),
+]
+
+
+def expected(document, key):
+    value = json.loads(document)
+    # The array under the key, or the whole document when it is missing
+    if isinstance(value, dict) and key in value:
+        value = value[key]
+    return value if isinstance(value, list) else [value]
+
+
+def splits(data):
+    # Every split of the body into two chunks, and one byte per chunk
+    for i in range(1, len(data)):
+        yield [data[:i], data[i:]]
+    yield [data[i : i + 1] for i in range(len(data))]
+
+
+@pytest.mark.parametrize("document,key", DOCUMENTS)
+def test_stream_json_at_every_chunk_boundary(document, key):
+    data = document.encode()
+    for chunks in splits(data):
+        assert list(stream_json(iter(chunks), key)) == expected(
+            document, key
+        ), chunks
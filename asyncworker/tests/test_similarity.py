@@ -0,0 +1,85 @@
+from types import SimpleNamespace
+
+import numpy as np
+from billiard.pool import Pool
+
+from asyncworker.tasks import similarity
+
+TEXTS = [f"The runners were running to the station {i}" for i in range(600)]
+
+
+def tokenize_in_child():
+    return list(similarity.tokenize_many(TEXTS, processes=2, chunk_size=100))
+
+
+def test_tokenize_many_keeps_order():
+    tokens = list(similarity.tokenize_many(TEXTS, processes=2, chunk_size=100))
+    assert tokens == list(similarity.tokenize_many(TEXTS, processes=1))
+    assert tokens[7][-1] == "7"
+
+
+def test_tokenize_many_in_daemon_process():
+    # Celery's prefork children are daemons
+    with Pool(1) as pool:
+        tokens = pool.apply(tokenize_in_child)
+    assert len(tokens) == len(TEXTS)
+    assert tokens[599][-1] == "599"
+
+
+def test_run_mode_refits_after_enough_fold_ins():
+    changed = np.zeros(100, dtype=bool)
+    changed[:5] = True
+    previous = SimpleNamespace(folded=10)
+    assert similarity.run_mode(previous, True, changed, changed, []) == (
+        True,
+        True,
+    )
+    # Each run is small, but the fold-ins add up past MAX_CHANGED_RATIO
+    previous.folded = 16
+    assert similarity.run_mode(previous, True, changed, changed, []) == (
+        False,
+        False,
+    )
+
+
+def test_incremental_run_matches_full_neighbours(monkeypatch, tmp_path):
+    # The worker reads config.json from its working directory on import
+    (tmp_path / "config.json").write_text("{}")
+    monkeypatch.chdir(tmp_path)
+    # pylint: disable=import-outside-toplevel
+    from asyncworker.benchmarks.similarity import Driver, Redis, make_corpus
+    from asyncworker.tasks import tasks, utils
+    from asyncworker.tasks.clients import init_similarity_settings
+
+    driver = Driver(make_corpus(300))
+    store = similarity.ModelStore(str(tmp_path / "models"))
+    task = tasks.find_similarities
+    monkeypatch.setattr(task, "_neo4j_client", driver)
+    monkeypatch.setattr(task, "_redis_client", Redis())
+    monkeypatch.setattr(task, "_model_store", store)
+    monkeypatch.setattr(
+        task,
+        "_similarity_settings",
+        {**init_similarity_settings(), "processes": 1},
+    )
+    task(incremental=False)
+
+    movies = driver.movies
+    for i in (3, 150):
+        movies[i]["movie"]["plot"] += " A sequel follows."
+    for i in (40, 220):
+        movies[i]["genres"] = ["war"]
+        movies[i]["categories"] = []
+    del movies[77]
+    task(incremental=True)
+
+    model = store.load()
+    assert model.folded == 2
+    assert model.slugs == [movie["movie"]["slug"] for movie in movies]
+    scores = similarity.BlendedScores(
+        model.vectors, utils.correlation_features(movies)
+    )
+    ids, expected = scores.neighbours(np.arange(len(movies)))
+    scores.close()
+    np.testing.assert_allclose(model.neighbour_scores, expected, atol=1e-5)
+    np.testing.assert_array_equal(model.neighbour_ids, ids)
@@ -0,0 +1,61 @@
+import numpy as np
+import pandas as pd
+
+from asyncworker.tasks import utils
+
+GENRES = ["drama", "comedy", "horror", "war"]
+CATEGORIES = ["art", "sport", "music", "law", "food", "travel"]
+
+
+def make_movies(size, seed=0):
+    # Scores of 0 and 1 tie with the label columns, so the average ranks of
+    # ties are checked too
+    rng = np.random.default_rng(seed)
+    movies = []
+    for _ in range(size):
+        values = rng.choice(
+            [0.0, 1.0, 0.3, 0.7, 2.5, 6.0, 8.0], len(utils.FEATURE_KEYS)
+        )
+        movies.append(
+            {
+                "movie": dict(zip(utils.FEATURE_KEYS, values.tolist())),
+                "genres": list(rng.choice(GENRES, rng.integers(1, 3))),
+                "categories": list(
+                    rng.choice(CATEGORIES, rng.integers(0, 4), replace=False)
+                ),
+            }
+        )
+    return movies
+
+
+def spearman(movies):
+    # Every movie is a row of its numeric features and multi-hot labels
+    labels = sorted(GENRES) + sorted(CATEGORIES)
+    frame = pd.DataFrame(
+        [
+            [movie["movie"][key] for key in utils.FEATURE_KEYS]
+            + [
+                float(label in movie["genres"] or label in movie["categories"])
+                for label in labels
+            ]
+            for movie in movies
+        ]
+    )
+    return frame.T.corr("spearman").to_numpy()
+
+
+def test_correlation_features_match_pandas_spearman():
+    movies = make_movies(12)
+    features = utils.correlation_features(movies)
+    expected = spearman(movies)
+    rows = np.arange(len(movies))
+
+    np.testing.assert_allclose(features.block(rows), expected, atol=1e-5)
+    columns = np.array([rows[::-1], np.roll(rows, 3)]).T
+    np.testing.assert_allclose(
+        features.pairs(rows, columns),
+        expected[rows[:, None], columns],
+        atol=1e-5,
+    )
+    dense = features.dense()
+    np.testing.assert_allclose(dense.dot(dense.T), expected, atol=1e-5)